@@ -1,9 +1,14 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 from langfuse.decorators import langfuse_context
 from config import settings
-from routers import chat, multimodal, router
+from cache import get_cache
+from sessions import get_session_store
+from deadlines import RequestCancelled, cancellation_stats
+from profiling import ProfilingMiddleware, profiling_enabled
+from routers import admin, chat, multimodal, router
 import logging
 
 logger = logging.getLogger(__name__)
@@ -19,10 +24,14 @@ async def lifespan(app: FastAPI):
     logger.info("Configuration loaded successfully")
     logger.info(f"Models: gpt-5-mini, Phi-4-multimodal-instruct")
     logger.info("=" * 80)
+    # Fail fast on an invalid session store configuration
+    get_session_store()
     yield
     # Shutdown: Flush Langfuse events
     logger.info("Flushing Langfuse events...")
     langfuse_context.flush()
+    get_cache().close()
+    get_session_store().close()
     logger.info("Shutdown complete")
 
 
@@ -47,10 +56,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-request profiling is opt-in; without it the middleware is not installed at all
+if profiling_enabled():
+    logger.info(
+        f"Request profiling enabled (sample rate {settings.profiling_sample_rate}, "
+        f"output {settings.profiling_dir})"
+    )
+    app.add_middleware(ProfilingMiddleware)
+
+
+@app.exception_handler(RequestCancelled)
+async def request_cancelled_handler(request: Request, exc: RequestCancelled):
+    """Deadline exceeded → 504, client disconnected → 499"""
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)})
+
+
 # Include routers
 app.include_router(chat.router)
 app.include_router(multimodal.router)
 app.include_router(router.router_api)
+app.include_router(admin.router)
 
 
 @app.get("/")
@@ -62,7 +87,10 @@ async def root():
             "POST /router/ask": "Main endpoint - Ask any question (with optional image, includes PII redaction)",
             "POST /chat/ask": "Direct text chat (no routing)",
             "POST /multimodal/ask-with-image": "Direct multimodal (no routing)",
-            "GET /health": "Health check"
+            "GET /health": "Health check",
+            "GET /cache/stats": "Per-namespace cache statistics",
+            "GET /metrics": "Cancellation counters",
+            "GET /admin/profiles": "Recent request profiles (requires X-Profile-Token)"
         }
     }
 
@@ -71,3 +99,19 @@ async def root():
 async def health():
     """Health check endpoint"""
     return {"status": "healthy"}
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Per-namespace cache statistics for the configured backend
+
+    A plain ``def`` so the backend queries run in the threadpool.
+    """
+    cache = get_cache()
+    return {"backend": cache.name, "namespaces": cache.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Counters of cancelled requests and the work skipped because of them"""
+    return {"cancellations": cancellation_stats()}
@@ -0,0 +1,809 @@
+"""Shared cache backends for router, page and answer caching
+
+Every backend stores values under a ``namespace`` (e.g. ``router``, ``pages``,
+``answers``) so that byte usage and hit rates can be reported per feature.
+Three implementations are available and selected via ``settings.cache_backend``:
+
+- ``memory``: in-process LRU, fastest but private to a single worker
+- ``shm``: SQLite database on a tmpfs path (``/dev/shm``), shared by all
+  uvicorn workers on the same host
+- ``redis``: any server speaking the Redis protocol, shared across replicas
+- ``none``: caching disabled
+
+Values are stored as JSON so that data read back from a shared cache can never
+execute code, and callers convert their own objects to and from plain dicts.
+Hit/miss/set/eviction counters are kept in the backend itself, so the shm and
+redis backends report totals across all workers and replicas.
+"""
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from typing import Any, Iterator, Optional
+from urllib.parse import urlparse
+import hashlib
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the shape of a cached value changes; shared caches then ignore
+# entries written by older code during a rolling deploy
+CACHE_SCHEMA_VERSION = 2
+
+# How often each worker pushes its buffered counters to a shared backend
+STATS_FLUSH_SECONDS = 1.0
+
+# Polling interval while waiting for a lock held by another worker
+LOCK_POLL_SECONDS = 0.01
+
+
+def make_key(*parts: Any) -> str:
+    """Build a compact, fixed-length cache key from arbitrary parts
+
+    Bytes are hashed as-is; everything else is hashed via ``str()``.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def serialize(value: Any) -> bytes:
+    """Serialize a JSON-compatible value for storage (tuples come back as lists)"""
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def deserialize(data: bytes) -> Any:
+    """Deserialize a value produced by ``serialize``"""
+    return json.loads(data)
+
+
+@dataclass
+class CacheStats:
+    """Counters for a single cache namespace"""
+    hits: int = 0
+    misses: int = 0
+    sets: int = 0
+    evictions: int = 0
+    bytes: int = 0
+    entries: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "hit_rate": round(self.hit_rate, 4)}
+
+
+class CacheBackend(ABC):
+    """Base class for cache backends
+
+    Subclasses implement the raw byte operations; serialization, TTL defaults,
+    the per-value byte limit and hit/miss accounting live here. Counters are
+    buffered per process and flushed to the backend's ``_store_stats`` at most
+    every ``stats_flush_seconds``; the default implementation keeps them in
+    process memory.
+    """
+
+    name = "base"
+    stats_flush_seconds = 0.0
+
+    def __init__(self, max_bytes: int, default_ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._pending: defaultdict[str, Counter] = defaultdict(Counter)
+        self._last_flush = time.monotonic()
+        self._stats_lock = threading.Lock()
+        self._local_stats: defaultdict[str, Counter] = defaultdict(Counter)
+
+    def _record(self, namespace: str, field: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            self._pending[namespace][field] += amount
+            due = time.monotonic() - self._last_flush >= self.stats_flush_seconds
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self) -> None:
+        """Push buffered counters to the backend"""
+        with self._stats_lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            self._store_stats(pending)
+        except Exception as e:
+            logger.warning(f"Cache stats flush failed ({self.name}): {e}")
+
+    def _store_stats(self, deltas: dict[str, Counter]) -> None:
+        with self._stats_lock:
+            for namespace, counters in deltas.items():
+                self._local_stats[namespace].update(counters)
+
+    def _load_stats(self) -> dict[str, dict[str, int]]:
+        with self._stats_lock:
+            return {namespace: dict(counters) for namespace, counters in self._local_stats.items()}
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        """Return the cached value or ``default`` if missing, expired or unreadable
+
+        Entries that cannot be deserialized (e.g. written by incompatible code)
+        are deleted and count as a miss.
+        """
+        try:
+            data = self._get(namespace, key)
+        except Exception as e:
+            logger.warning(f"Cache get failed ({self.name}/{namespace}): {e}")
+            data = None
+        if data is not None:
+            try:
+                value = deserialize(data)
+            except ValueError as e:
+                logger.warning(f"Dropping unreadable cache entry ({self.name}/{namespace}): {e}")
+                try:
+                    self._delete(namespace, key)
+                except Exception:
+                    pass
+                data = None
+        if data is None:
+            self._record(namespace, "misses")
+            return default
+        self._record(namespace, "hits")
+        return value
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Store a value; returns False if it was rejected or the backend failed"""
+        try:
+            data = serialize(value)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Cache value not serializable ({namespace}): {e}")
+            return False
+        if len(data) > self.max_bytes:
+            logger.debug(f"Cache value too large for {namespace}: {len(data)} bytes")
+            return False
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        try:
+            self._set(namespace, key, data, expires_at)
+        except Exception as e:
+            logger.warning(f"Cache set failed ({self.name}/{namespace}): {e}")
+            return False
+        self._record(namespace, "sets")
+        return True
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._delete(namespace, key)
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        """Remove all entries of a namespace, or of every namespace"""
+        self._clear(namespace)
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 10.0, ttl: float = 30.0) -> Iterator[None]:
+        """Mutex shared by everyone using this backend
+
+        The lock expires after ``ttl`` seconds so a crashed holder cannot block
+        others forever; raises ``TimeoutError`` if not acquired within ``timeout``.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not self._acquire(name, token, ttl):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Could not acquire cache lock {name!r}")
+            time.sleep(LOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            try:
+                self._release(name, token)
+            except Exception as e:
+                logger.warning(f"Cache lock release failed ({self.name}/{name}): {e}")
+
+    def stats(self) -> dict[str, dict]:
+        """Per-namespace counters and usage as stored in the backend
+
+        Blocking: call from a worker thread, not the event loop.
+        """
+        self.flush_stats()
+        counter_fields = {f.name for f in fields(CacheStats)} - {"bytes", "entries"}
+        snapshot: dict[str, CacheStats] = {}
+        for namespace, counters in self._load_stats().items():
+            snapshot[namespace] = CacheStats(
+                **{name: int(value) for name, value in counters.items() if name in counter_fields}
+            )
+        for namespace, (size, entries) in self._usage().items():
+            stats = snapshot.setdefault(namespace, CacheStats())
+            stats.bytes, stats.entries = size, entries
+        return {ns: s.to_dict() for ns, s in snapshot.items()}
+
+    def close(self) -> None:
+        self.flush_stats()
+
+    @abstractmethod
+    def _get(self, namespace: str, key: str) -> Optional[bytes]: ...
+
+    @abstractmethod
+    def _set(self, namespace: str, key: str, data: bytes, expires_at: Optional[float]) -> None: ...
+
+    @abstractmethod
+    def _delete(self, namespace: str, key: str) -> None: ...
+
+    @abstractmethod
+    def _clear(self, namespace: Optional[str]) -> None: ...
+
+    @abstractmethod
+    def _usage(self) -> dict[str, tuple[int, int]]:
+        """Return ``{namespace: (bytes, entries)}``"""
+
+    @abstractmethod
+    def _acquire(self, name: str, token: str, ttl: float) -> bool:
+        """Take the lock ``name`` for ``token`` unless someone else holds it"""
+
+    @abstractmethod
+    def _release(self, name: str, token: str) -> None:
+        """Release the lock ``name`` if it is still held by ``token``"""
+
+
+class NullCache(CacheBackend):
+    """Backend that never stores anything (``cache_backend=none``)"""
+
+    name = "none"
+
+    def _get(self, namespace, key):
+        return None
+
+    def _set(self, namespace, key, data, expires_at):
+        pass
+
+    def _delete(self, namespace, key):
+        pass
+
+    def _clear(self, namespace):
+        pass
+
+    def _usage(self):
+        return {}
+
+    def _acquire(self, name, token, ttl):
+        return True
+
+    def _release(self, name, token):
+        pass
+
+
+class InProcessLRUCache(CacheBackend):
+    """Thread-safe LRU bounded by total stored bytes, private to one process"""
+
+    name = "memory"
+
+    def __init__(self, max_bytes: int, default_ttl: Optional[float] = None):
+        super().__init__(max_bytes, default_ttl)
+        self._entries: OrderedDict[tuple[str, str], tuple[bytes, Optional[float]]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Locks live outside the LRU so they are never evicted
+        self._locks: dict[str, tuple[str, float]] = {}
+
+    def _pop(self, entry_key: tuple[str, str]) -> None:
+        data, _ = self._entries.pop(entry_key)
+        self._bytes -= len(data)
+
+    def _get(self, namespace, key):
+        entry_key = (namespace, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._pop(entry_key)
+                return None
+            self._entries.move_to_end(entry_key)
+            return data
+
+    def _set(self, namespace, key, data, expires_at):
+        entry_key = (namespace, key)
+        evicted = []
+        with self._lock:
+            if entry_key in self._entries:
+                self._pop(entry_key)
+            self._entries[entry_key] = (data, expires_at)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+                evicted.append(oldest[0])
+        for evicted_namespace in evicted:
+            self._record(evicted_namespace, "evictions")
+
+    def _delete(self, namespace, key):
+        with self._lock:
+            if (namespace, key) in self._entries:
+                self._pop((namespace, key))
+
+    def _clear(self, namespace):
+        with self._lock:
+            for entry_key in [k for k in self._entries if namespace is None or k[0] == namespace]:
+                self._pop(entry_key)
+
+    def _usage(self):
+        usage: dict[str, tuple[int, int]] = {}
+        with self._lock:
+            for (namespace, _), (data, _) in self._entries.items():
+                size, entries = usage.get(namespace, (0, 0))
+                usage[namespace] = (size + len(data), entries + 1)
+        return usage
+
+    def _acquire(self, name, token, ttl):
+        now = time.monotonic()
+        with self._lock:
+            held = self._locks.get(name)
+            if held is not None and held[1] > now:
+                return False
+            self._locks[name] = (token, now + ttl)
+            return True
+
+    def _release(self, name, token):
+        with self._lock:
+            held = self._locks.get(name)
+            if held is not None and held[0] == token:
+                del self._locks[name]
+
+
+class SharedMemoryCache(CacheBackend):
+    """LRU shared by all processes on a host, backed by SQLite on tmpfs
+
+    Keeping the database under ``/dev/shm`` means reads and writes never touch
+    disk, while SQLite provides the cross-process locking. Table names carry
+    ``CACHE_SCHEMA_VERSION`` so entries of older releases are never read.
+    """
+
+    name = "shm"
+    stats_flush_seconds = STATS_FLUSH_SECONDS
+
+    def __init__(self, path: str, max_bytes: int, default_ttl: Optional[float] = None):
+        super().__init__(max_bytes, default_ttl)
+        self.path = path
+        self.table = f"cache_v{CACHE_SCHEMA_VERSION}"
+        self.stats_table = f"cache_stats_v{CACHE_SCHEMA_VERSION}"
+        self.locks_table = f"cache_locks_v{CACHE_SCHEMA_VERSION}"
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL,"
+            " accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed_at)"
+        )
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.stats_table} ("
+            " namespace TEXT NOT NULL,"
+            " field TEXT NOT NULL,"
+            " value INTEGER NOT NULL,"
+            " PRIMARY KEY (namespace, field))"
+        )
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.locks_table} ("
+            " name TEXT PRIMARY KEY,"
+            " token TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, namespace, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            f"SELECT value, expires_at FROM {self.table} WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        data, expires_at = row
+        if expires_at is not None and expires_at <= now:
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+            return None
+        conn.execute(
+            f"UPDATE {self.table} SET accessed_at = ? WHERE namespace = ? AND key = ?",
+            (now, namespace, key)
+        )
+        return data
+
+    def _set(self, namespace, key, data, expires_at):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, data, len(data), expires_at, now)
+            )
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+            )
+            total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+            evicted = []
+            while total > self.max_bytes:
+                row = conn.execute(
+                    f"SELECT namespace, key, size FROM {self.table} ORDER BY accessed_at LIMIT 1"
+                ).fetchone()
+                conn.execute(f"DELETE FROM {self.table} WHERE namespace = ? AND key = ?", row[:2])
+                evicted.append(row[0])
+                total -= row[2]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for evicted_namespace in evicted:
+            self._record(evicted_namespace, "evictions")
+
+    def _delete(self, namespace, key):
+        self._connect().execute(
+            f"DELETE FROM {self.table} WHERE namespace = ? AND key = ?", (namespace, key)
+        )
+
+    def _clear(self, namespace):
+        if namespace is None:
+            self._connect().execute(f"DELETE FROM {self.table}")
+        else:
+            self._connect().execute(f"DELETE FROM {self.table} WHERE namespace = ?", (namespace,))
+
+    def _store_stats(self, deltas):
+        rows = [
+            (namespace, field, amount)
+            for namespace, counters in deltas.items()
+            for field, amount in counters.items()
+        ]
+        self._connect().executemany(
+            f"INSERT INTO {self.stats_table} VALUES (?, ?, ?)"
+            " ON CONFLICT (namespace, field) DO UPDATE SET value = value + excluded.value",
+            rows
+        )
+
+    def _load_stats(self):
+        stats: dict[str, dict[str, int]] = {}
+        rows = self._connect().execute(
+            f"SELECT namespace, field, value FROM {self.stats_table}"
+        ).fetchall()
+        for namespace, field, value in rows:
+            stats.setdefault(namespace, {})[field] = value
+        return stats
+
+    def _usage(self):
+        rows = self._connect().execute(
+            f"SELECT namespace, SUM(size), COUNT(*) FROM {self.table} GROUP BY namespace"
+        ).fetchall()
+        return {namespace: (size, entries) for namespace, size, entries in rows}
+
+    def _acquire(self, name, token, ttl):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"DELETE FROM {self.locks_table} WHERE name = ? AND expires_at <= ?", (name, now)
+            )
+            acquired = conn.execute(
+                f"INSERT OR IGNORE INTO {self.locks_table} VALUES (?, ?, ?)", (name, token, now + ttl)
+            ).rowcount == 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def _release(self, name, token):
+        self._connect().execute(
+            f"DELETE FROM {self.locks_table} WHERE name = ? AND token = ?", (name, token)
+        )
+
+    def close(self) -> None:
+        super().close()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisError(Exception):
+    """Error reply returned by a Redis-protocol server"""
+
+
+class RedisCache(CacheBackend):
+    """Cache on any Redis-protocol server (Redis, Valkey, KeyDB, Dragonfly, ...)
+
+    Uses a minimal RESP2 client over a plain socket so no extra dependency is
+    needed. The byte budget applies per value; the global memory limit and
+    eviction policy are the server's ``maxmemory`` settings.
+
+    Keys are laid out as ``<prefix>:v<schema>:data:<namespace>:<key>``; counters
+    live in one hash per namespace (``<prefix>:v<schema>:stats:<namespace>``)
+    and the set ``<prefix>:v<schema>:namespaces`` lists the namespaces seen.
+    """
+
+    name = "redis"
+    stats_flush_seconds = STATS_FLUSH_SECONDS
+
+    def __init__(
+        self,
+        url: str,
+        max_bytes: int,
+        default_ttl: Optional[float] = None,
+        key_prefix: str = "lego-case",
+        timeout: float = 2.0
+    ):
+        super().__init__(max_bytes, default_ttl)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.key_prefix = f"{key_prefix}:v{CACHE_SCHEMA_VERSION}"
+        self.timeout = timeout
+        self._local = threading.local()
+        self._memory_usage_supported: Optional[bool] = None
+
+    def _key(self, namespace: str, key: str) -> bytes:
+        return f"{self.key_prefix}:data:{namespace}:{key}".encode("utf-8")
+
+    def _stats_key(self, namespace: str) -> str:
+        return f"{self.key_prefix}:stats:{namespace}"
+
+    def _lock_key(self, name: str) -> str:
+        return f"{self.key_prefix}:lock:{name}"
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = (sock, sock.makefile("rb"))
+            self._local.conn = conn
+            if self.password:
+                self._execute(b"AUTH", self.password)
+            if self.db:
+                self._execute(b"SELECT", self.db)
+        return conn
+
+    @staticmethod
+    def _encode(args: tuple) -> bytes:
+        parts = [arg if isinstance(arg, bytes) else str(arg).encode("utf-8") for arg in args]
+        return b"*%d\r\n" % len(parts) + b"".join(
+            b"$%d\r\n%s\r\n" % (len(part), part) for part in parts
+        )
+
+    def _execute(self, *args: Any) -> Any:
+        return self._pipeline([args])[0]
+
+    def _pipeline(self, commands: list[tuple]) -> list[Any]:
+        """Send several commands in one round trip and return their replies
+
+        Every reply is read before an error reply is raised, so the
+        connection stays in sync.
+        """
+        if not commands:
+            return []
+        sock, reader = self._connection()
+        try:
+            sock.sendall(b"".join(self._encode(args) for args in commands))
+            replies = []
+            for _ in commands:
+                try:
+                    replies.append(self._read_reply(reader))
+                except RedisError as e:
+                    replies.append(e)
+        except (OSError, ConnectionError):
+            self._drop_connection()
+            raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _read_reply(self, reader) -> Any:
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body
+        if kind == b"-":
+            raise RedisError(body.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            # Read every element even if one is an error so the stream stays aligned
+            items = []
+            error = None
+            for _ in range(length):
+                try:
+                    items.append(self._read_reply(reader))
+                except RedisError as e:
+                    error = error or e
+            if error is not None:
+                raise error
+            return items
+        raise ConnectionError(f"Unexpected Redis reply type: {line!r}")
+
+    def _drop_connection(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            try:
+                conn[0].close()
+            except OSError:
+                pass
+
+    def _get(self, namespace, key):
+        return self._execute(b"GET", self._key(namespace, key))
+
+    def _set(self, namespace, key, data, expires_at):
+        if expires_at is None:
+            self._execute(b"SET", self._key(namespace, key), data)
+            return
+        ttl_ms = max(1, int((expires_at - time.time()) * 1000))
+        self._execute(b"SET", self._key(namespace, key), data, b"PX", ttl_ms)
+
+    def _delete(self, namespace, key):
+        self._execute(b"DEL", self._key(namespace, key))
+
+    def _scan(self, pattern: str):
+        cursor = b"0"
+        while True:
+            cursor, keys = self._execute(b"SCAN", cursor, b"MATCH", pattern, b"COUNT", 500)
+            yield from keys
+            if cursor == b"0":
+                break
+
+    def _clear(self, namespace):
+        pattern = f"{self.key_prefix}:data:{namespace or '*'}:*"
+        keys = list(self._scan(pattern))
+        for start in range(0, len(keys), 500):
+            self._execute(b"DEL", *keys[start:start + 500])
+
+    def _store_stats(self, deltas):
+        commands = [(b"SADD", f"{self.key_prefix}:namespaces", *deltas)]
+        for namespace, counters in deltas.items():
+            for field, amount in counters.items():
+                commands.append((b"HINCRBY", self._stats_key(namespace), field, amount))
+        self._pipeline(commands)
+
+    def _load_stats(self):
+        namespaces = [
+            ns.decode("utf-8") for ns in self._execute(b"SMEMBERS", f"{self.key_prefix}:namespaces")
+        ]
+        replies = self._pipeline([(b"HGETALL", self._stats_key(ns)) for ns in namespaces])
+        stats: dict[str, dict[str, int]] = {}
+        for namespace, flat in zip(namespaces, replies):
+            stats[namespace] = {
+                flat[i].decode("utf-8"): int(flat[i + 1]) for i in range(0, len(flat), 2)
+            }
+        return stats
+
+    def _batch_sizes(self, keys: list[bytes]) -> list[Optional[int]]:
+        if self._memory_usage_supported is None:
+            # Not every Redis-protocol server implements MEMORY USAGE; probe
+            # once outside a pipeline since some reply with an error and
+            # others close the connection on unknown commands
+            try:
+                self._execute(b"MEMORY", b"USAGE", keys[0])
+                self._memory_usage_supported = True
+            except (RedisError, OSError) as e:
+                logger.info(f"MEMORY USAGE unavailable, sizing Redis entries with STRLEN: {e}")
+                self._memory_usage_supported = False
+                self._drop_connection()
+        if self._memory_usage_supported:
+            return self._pipeline([(b"MEMORY", b"USAGE", key) for key in keys])
+        sizes = self._pipeline([(b"STRLEN", key) for key in keys])
+        return [size or None for size in sizes]
+
+    def _usage(self):
+        # One pipelined size query per SCAN batch instead of a round trip per key
+        usage: dict[str, tuple[int, int]] = {}
+        data_prefix = len(f"{self.key_prefix}:data:")
+        try:
+            keys = list(self._scan(f"{self.key_prefix}:data:*"))
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                sizes = self._batch_sizes(batch)
+                for raw_key, size in zip(batch, sizes):
+                    if size is None:
+                        continue  # expired between SCAN and MEMORY USAGE
+                    namespace = raw_key.decode("utf-8")[data_prefix:].split(":", 1)[0]
+                    total, entries = usage.get(namespace, (0, 0))
+                    usage[namespace] = (total + size, entries + 1)
+        except Exception as e:
+            logger.warning(f"Could not read Redis cache usage: {e}")
+        return usage
+
+    def _acquire(self, name, token, ttl):
+        reply = self._execute(b"SET", self._lock_key(name), token, b"NX", b"PX", max(1, int(ttl * 1000)))
+        return reply is not None
+
+    def _release(self, name, token):
+        # GET + DEL is not atomic, but a lock can only be stolen after its TTL
+        if self._execute(b"GET", self._lock_key(name)) == token.encode("utf-8"):
+            self._execute(b"DEL", self._lock_key(name))
+
+    def close(self) -> None:
+        super().close()
+        self._drop_connection()
+
+
+def create_cache(
+    backend: str,
+    max_bytes: int,
+    default_ttl: Optional[float] = None,
+    shm_path: str = "/dev/shm/lego-case-cache.sqlite3",
+    redis_url: str = "redis://localhost:6379/0",
+    key_prefix: str = "lego-case"
+) -> CacheBackend:
+    """Instantiate a cache backend by name"""
+    backend = backend.lower()
+    if backend == "memory":
+        return InProcessLRUCache(max_bytes, default_ttl)
+    if backend == "shm":
+        return SharedMemoryCache(shm_path, max_bytes, default_ttl)
+    if backend == "redis":
+        return RedisCache(redis_url, max_bytes, default_ttl, key_prefix=key_prefix)
+    if backend == "none":
+        return NullCache(max_bytes, default_ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+_cache: Optional[CacheBackend] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CacheBackend:
+    """Return the process-wide cache selected by ``settings.cache_backend``"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from config import settings
+                _cache = create_cache(
+                    settings.cache_backend,
+                    max_bytes=settings.cache_max_bytes,
+                    default_ttl=settings.cache_default_ttl_seconds or None,
+                    shm_path=settings.cache_shm_path,
+                    redis_url=settings.cache_redis_url
+                )
+                logger.info(f"Cache backend: {_cache.name}")
+    return _cache
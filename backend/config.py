@@ -1,3 +1,4 @@
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import os
 import logging
@@ -39,6 +40,47 @@ class Settings(BaseSettings):
     
     # Claude Configuration (defaults to Azure AI Foundry endpoint)
     claude_endpoint: str = "https://manue-mg9c9a0z-eastus2.services.ai.azure.com/anthropic/"
+    
+    # Cache Configuration (shared by router, rendered-page and answer caches)
+    cache_backend: str = "memory"  # memory | shm | redis | none
+    cache_max_bytes: int = 256 * 1024 * 1024  # Total byte budget (per value limit for redis)
+    cache_default_ttl_seconds: int = 3600  # 0 disables expiry
+    cache_shm_path: str = "/dev/shm/lego-case-cache.sqlite3"  # Used by the shm backend
+    cache_redis_url: str = "redis://localhost:6379/0"  # Used by the redis backend
+    
+    # Request Deadline Configuration (overridable per request via X-Request-Timeout)
+    request_timeout_seconds: float = 60.0  # Default deadline for a request
+    multimodal_request_timeout_seconds: float = 180.0  # Default for /multimodal (one model call per PDF page)
+    request_timeout_max_seconds: float = 300.0  # Upper bound for the header value
+    
+    # Profiling Configuration (disabled unless a token is set)
+    profiling_token: str = ""  # Requests with a matching X-Profile-Token header are profiled
+    profiling_sample_rate: float = 0.0  # Fraction of requests profiled at random (requires a token)
+    profiling_interval_ms: float = 5.0  # Stack sampling interval
+    profiling_dir: str = "/tmp/lego-case-profiles"  # Where profiles are written
+    profiling_max_profiles: int = 50  # Older profiles are deleted
+    
+    # PDF Configuration
+    pdf_max_pages: int = 5  # Most relevant pages rendered and sent to the model
+    
+    # Chat Session Configuration
+    session_store: str = "memory"  # memory | cache (shared, same backend type as cache_backend)
+    session_max_sessions: int = 1000  # Max sessions kept by the memory store
+    session_cache_max_bytes: int = 64 * 1024 * 1024  # Byte budget of the session cache, separate from cache_max_bytes
+    session_cache_shm_path: str = "/dev/shm/lego-case-sessions.sqlite3"  # Session database for the shm backend
+    session_cache_redis_url: str = ""  # Redis for sessions (e.g. a separate DB); defaults to cache_redis_url
+    session_ttl_seconds: int = 3600  # Idle time before a session expires
+    session_history_token_budget: int = 2000  # Max history tokens sent per turn
+    
+    @model_validator(mode="after")
+    def check_profiling(self) -> "Settings":
+        # Profiles are only readable through /admin, which requires the token
+        if self.profiling_sample_rate > 0 and not self.profiling_token:
+            raise ValueError(
+                "PROFILING_SAMPLE_RATE requires PROFILING_TOKEN; "
+                "without it sampled profiles could not be listed via /admin"
+            )
+        return self
 
 
 # Load settings with error handling
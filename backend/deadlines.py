@@ -0,0 +1,190 @@
+"""Request-scoped deadlines and client-disconnect cancellation
+
+Each request gets a ``RequestContext`` with a deadline taken from the
+``X-Request-Timeout`` header, or else the endpoint's default
+(``settings.request_timeout_seconds`` unless the route overrides it).
+Blocking work runs in the threadpool via ``run_with_cancellation``, which
+gives up as soon as the client disconnects or the deadline passes. The worker
+thread checks ``ctx.check()`` between pages and stream events so remaining
+rendering and upstream calls are skipped, and upstream calls get a timeout no
+longer than the time left.
+"""
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import asyncio
+import logging
+import threading
+import time
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+from config import settings
+from profiling import current_profile
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+
+# How often the event loop checks for client disconnects while work is running
+DISCONNECT_POLL_SECONDS = 0.25
+
+# Upstream calls always get at least this long, even right before the deadline
+MIN_UPSTREAM_TIMEOUT_SECONDS = 0.5
+
+_metrics: Counter = Counter()
+_metrics_lock = threading.Lock()
+
+
+def record_cancellation_metric(name: str, amount: int = 1) -> None:
+    with _metrics_lock:
+        _metrics[name] += amount
+
+
+def cancellation_stats() -> dict[str, int]:
+    """Counters of cancelled requests, skipped pages and abandoned upstream calls"""
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+class RequestCancelled(Exception):
+    """Raised when a request's deadline passes or its client disconnects"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+    @property
+    def status_code(self) -> int:
+        # 499 is the de facto "client closed request" status
+        return 504 if self.reason == "deadline" else 499
+
+
+@dataclass
+class RequestContext:
+    """Deadline and cancellation state for one request
+
+    Only these fields are serialized into Langfuse traces; the underlying
+    ``Request`` is kept as a plain attribute so headers never end up there.
+    """
+    endpoint: str
+    timeout: float
+    deadline: float
+    reason: Optional[str] = None
+
+    def __post_init__(self):
+        self.request: Optional[Request] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def upstream_timeout(self) -> float:
+        """Timeout for an upstream call so it cannot outlive the request"""
+        return max(MIN_UPSTREAM_TIMEOUT_SECONDS, self.remaining())
+
+    def cancel(self, reason: str) -> None:
+        if self.reason is not None:
+            return
+        self.reason = reason
+        record_cancellation_metric(f"requests_cancelled.{reason}")
+        record_cancellation_metric(f"requests_cancelled.{self.endpoint}")
+        logger.warning(f"Cancelling {self.endpoint} request: {reason}")
+
+    def check(self) -> None:
+        """Raise ``RequestCancelled`` if the request should stop"""
+        if self.reason is None and self.remaining() <= 0:
+            self.cancel("deadline")
+        if self.reason is not None:
+            raise RequestCancelled(self.reason)
+
+
+def parse_request_timeout(value: Optional[str], default: Optional[float] = None) -> float:
+    """Timeout in seconds from the header value, clamped to the configured maximum"""
+    if value:
+        try:
+            timeout = float(value)
+            if timeout > 0:
+                return min(timeout, settings.request_timeout_max_seconds)
+        except ValueError:
+            pass
+        logger.warning(f"Ignoring invalid {REQUEST_TIMEOUT_HEADER} header: {value!r}")
+    return settings.request_timeout_seconds if default is None else default
+
+
+def _create_context(request: Request, default_timeout: Optional[float]) -> RequestContext:
+    timeout = parse_request_timeout(request.headers.get(REQUEST_TIMEOUT_HEADER), default_timeout)
+    ctx = RequestContext(
+        endpoint=request.url.path,
+        timeout=timeout,
+        deadline=time.monotonic() + timeout
+    )
+    ctx.request = request
+    return ctx
+
+
+def request_context(request: Request) -> RequestContext:
+    """FastAPI dependency creating the context for the current request"""
+    return _create_context(request, None)
+
+
+def request_context_with_timeout(setting: str) -> Callable[[Request], RequestContext]:
+    """Like ``request_context``, with the default timeout read from ``settings.<setting>``
+
+    For endpoints that routinely need longer than ``request_timeout_seconds``.
+    """
+    def dependency(request: Request) -> RequestContext:
+        return _create_context(request, getattr(settings, setting))
+    return dependency
+
+
+def _consume_result(task: asyncio.Future) -> None:
+    # Abandoned work may still fail (e.g. an upstream timeout); retrieve the
+    # exception so it is not reported as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+
+async def run_with_cancellation(
+    ctx: RequestContext,
+    func: Callable[..., Any],
+    /,
+    *args,
+    upstream: bool = False,
+    **kwargs
+) -> Any:
+    """Run a blocking function in the threadpool, bounded by the request context
+
+    Returns as soon as the function finishes, the client disconnects or the
+    deadline passes; in the latter two cases ``RequestCancelled`` is raised and
+    the worker thread is told to stop at its next ``ctx.check()``. Pass
+    ``upstream=True`` when ``func`` calls a model, so that abandoning it is
+    counted in ``upstream_calls_abandoned``.
+    """
+    profile = current_profile()
+    if profile is not None:
+        func = profile.track(func)
+    task = asyncio.ensure_future(run_in_threadpool(func, *args, **kwargs))
+    while True:
+        done, _ = await asyncio.wait(
+            {task}, timeout=max(0.0, min(DISCONNECT_POLL_SECONDS, ctx.remaining()))
+        )
+        if task in done:
+            return task.result()
+        if ctx.cancelled:
+            break
+        if ctx.remaining() <= 0:
+            ctx.cancel("deadline")
+            break
+        if ctx.request is not None and await ctx.request.is_disconnected():
+            ctx.cancel("disconnect")
+            break
+
+    task.add_done_callback(_consume_result)
+    if upstream:
+        record_cancellation_metric("upstream_calls_abandoned")
+    raise RequestCancelled(ctx.reason)
@@ -0,0 +1,121 @@
+"""Relevance-ranked page selection for PDF documents
+
+Builds an in-memory BM25 inverted index over the text of each PDF page so
+that only the pages most relevant to a question are rendered and sent to the
+multimodal model. Indexes are built once per document and cached by the
+document's hash.
+"""
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+import logging
+import math
+import re
+
+import fitz  # PyMuPDF
+
+from cache import get_cache, make_key
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i in is it its "
+    "me my of on or our page that the this to was we were what when where which "
+    "who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokens without stopwords"""
+    return [
+        token for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOPWORDS
+    ]
+
+
+@dataclass
+class PageIndex:
+    """BM25 inverted index over the pages of one document"""
+    postings: dict[str, list[tuple[int, int]]]  # term -> [(page_num, term_freq)]
+    page_lengths: list[int]
+    k1: float = 1.5
+    b: float = 0.75
+
+    @classmethod
+    def from_texts(cls, page_texts: list[str]) -> "PageIndex":
+        postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        page_lengths = []
+        for page_num, text in enumerate(page_texts):
+            tokens = tokenize(text)
+            page_lengths.append(len(tokens))
+            for term, freq in Counter(tokens).items():
+                postings[term].append((page_num, freq))
+        return cls(postings=dict(postings), page_lengths=page_lengths)
+
+    def to_dict(self) -> dict:
+        return {
+            "postings": self.postings,
+            "page_lengths": self.page_lengths,
+            "k1": self.k1,
+            "b": self.b
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PageIndex":
+        postings = {
+            term: [(page_num, freq) for page_num, freq in entries]
+            for term, entries in data["postings"].items()
+        }
+        return cls(postings=postings, page_lengths=data["page_lengths"], k1=data["k1"], b=data["b"])
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_lengths)
+
+    def scores(self, query: str) -> dict[int, float]:
+        """BM25 score for every page matching at least one query term"""
+        page_count = self.page_count
+        avg_length = (sum(self.page_lengths) / page_count) if page_count else 0.0
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (page_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for page_num, freq in postings:
+                length_norm = 1 - self.b + self.b * self.page_lengths[page_num] / (avg_length or 1)
+                scores[page_num] += idf * freq * (self.k1 + 1) / (freq + self.k1 * length_norm)
+        return scores
+
+    def top_pages(self, query: str, k: int) -> list[int]:
+        """0-based numbers of the ``k`` most relevant pages, in document order
+
+        Only matching pages are returned, so fewer than ``k`` pages may come
+        back. Falls back to the first pages when the question matches nothing
+        (e.g. scanned documents without a text layer).
+        """
+        if self.page_count <= k:
+            return list(range(self.page_count))
+        scores = self.scores(query)
+        if not scores:
+            return list(range(k))
+        return sorted(sorted(scores, key=lambda page_num: (-scores[page_num], page_num))[:k])
+
+
+def build_page_index(doc: fitz.Document) -> PageIndex:
+    """Index the text layer of every page of an open document"""
+    return PageIndex.from_texts([page.get_text("text") for page in doc])
+
+
+def get_page_index(doc: fitz.Document, doc_hash: str) -> PageIndex:
+    """Return the cached index for a document, building it on first use"""
+    cache = get_cache()
+    cache_key = make_key(doc_hash)
+    cached = cache.get("page_index", cache_key)
+    if cached is not None:
+        return PageIndex.from_dict(cached)
+    index = build_page_index(doc)
+    cache.set("page_index", cache_key, index.to_dict())
+    logger.info(f"Built page index for {index.page_count} pages ({len(index.postings)} terms)")
+    return index
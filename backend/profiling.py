@@ -0,0 +1,241 @@
+"""On-demand per-request sampling profiler
+
+A request is profiled when it carries a valid ``X-Profile-Token`` header or
+is picked by ``settings.profiling_sample_rate``. While it runs, a background
+thread samples the stacks of the threads doing its work (the event loop
+thread plus any threadpool workers started through ``run_with_cancellation``)
+and the result is written to ``settings.profiling_dir`` as:
+
+- ``<id>.collapsed``: collapsed stacks, one ``frame;frame;frame count`` line per
+  unique stack, ready for ``flamegraph.pl`` or https://www.speedscope.app
+- ``<id>.json``: request metadata (path, status, wall/CPU time, samples)
+
+The middleware is only installed when profiling is enabled, so there is no
+overhead otherwise. Samples of the event loop thread can include other
+requests served concurrently. Profiles are read through the ``/admin``
+endpoints, which require the token, so a sample rate can only be configured
+together with a token.
+"""
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+import functools
+import hmac
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN_HEADER = "X-Profile-Token"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]{8}T[0-9]{12}-[0-9a-f]{8}$")
+
+_active_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("active_profile", default=None)
+
+
+def profiling_enabled() -> bool:
+    return bool(settings.profiling_token) or settings.profiling_sample_rate > 0
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """Constant-time check of a profiling token against the configured one"""
+    if not settings.profiling_token or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), settings.profiling_token.encode("utf-8"))
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = "/".join(Path(code.co_filename).parts[-2:])
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class RequestProfile:
+    """Samples the stacks of the threads working on one request"""
+
+    def __init__(self, method: str, path: str, interval: float):
+        # Timestamp first so profile files sort chronologically
+        self.profile_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.status_code: Optional[int] = None
+        self._threads: dict[int, str] = {}
+        self._threads_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def add_thread(self, ident: int, label: str) -> None:
+        with self._threads_lock:
+            self._threads[ident] = label
+
+    def remove_thread(self, ident: int) -> None:
+        with self._threads_lock:
+            self._threads.pop(ident, None)
+
+    def track(self, func: Callable) -> Callable:
+        """Wrap a function so the worker thread running it gets sampled"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ident = threading.get_ident()
+            self.add_thread(ident, "worker")
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.remove_thread(ident)
+        return wrapper
+
+    def start(self) -> None:
+        self.add_thread(threading.get_ident(), "event-loop")
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+        self.wall_ms = (time.perf_counter() - self._wall_start) * 1000
+        self.cpu_ms = (time.process_time() - self._cpu_start) * 1000
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._threads_lock:
+                threads = dict(self._threads)
+            frames = sys._current_frames()
+            for ident, label in threads.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(label)
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def metadata(self) -> dict:
+        return {
+            "id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "wall_ms": round(self.wall_ms, 2),
+            "cpu_ms": round(self.cpu_ms, 2),
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+
+    def write(self, directory: Path) -> Path:
+        directory.mkdir(parents=True, exist_ok=True)
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+        (directory / f"{self.profile_id}.collapsed").write_text(collapsed + "\n", encoding="utf-8")
+        (directory / f"{self.profile_id}.json").write_text(json.dumps(self.metadata()), encoding="utf-8")
+        return directory / f"{self.profile_id}.collapsed"
+
+
+def current_profile() -> Optional[RequestProfile]:
+    """Profile of the request being handled, if it is being profiled"""
+    return _active_profile.get()
+
+
+def list_profiles(limit: int = 20) -> list[dict]:
+    """Metadata of the most recent profiles, newest first"""
+    directory = Path(settings.profiling_dir)
+    if not directory.is_dir():
+        return []
+    profiles = []
+    for path in sorted(directory.glob("*.json"), reverse=True)[:limit]:
+        try:
+            profiles.append(json.loads(path.read_text(encoding="utf-8")))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable profile {path.name}: {e}")
+    return profiles
+
+
+def read_profile(profile_id: str) -> Optional[str]:
+    """Collapsed stacks of a profile, or None if it does not exist"""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = Path(settings.profiling_dir) / f"{profile_id}.collapsed"
+    return path.read_text(encoding="utf-8") if path.is_file() else None
+
+
+def _prune_profiles(directory: Path, keep: int) -> None:
+    for path in sorted(directory.glob("*.json"), reverse=True)[keep:]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".collapsed").unlink(missing_ok=True)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling requests selected by token or sampling rate"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _finish(profile: RequestProfile) -> None:
+        """Stop sampling and write the profile (blocking, runs in the threadpool)"""
+        profile.stop()
+        directory = Path(settings.profiling_dir)
+        try:
+            path = profile.write(directory)
+            _prune_profiles(directory, settings.profiling_max_profiles)
+            logger.info(
+                f"Profiled {profile.method} {profile.path}: {profile.wall_ms:.0f}ms wall, "
+                f"{profile.cpu_ms:.0f}ms CPU, {profile.samples} samples -> {path}"
+            )
+        except OSError as e:
+            logger.error(f"Failed to write profile {profile.profile_id}: {e}")
+
+    def _should_profile(self, scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name.decode("latin-1").lower() == PROFILE_TOKEN_HEADER.lower():
+                if is_authorized(value.decode("latin-1")):
+                    return True
+                logger.warning("Ignoring invalid profiling token")
+                break
+        return settings.profiling_sample_rate > 0 and random.random() < settings.profiling_sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/admin") or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(
+            scope["method"], scope["path"], settings.profiling_interval_ms / 1000
+        )
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((PROFILE_ID_HEADER.lower().encode("latin-1"), profile.profile_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _active_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            _active_profile.reset(token)
+            # Joining the sampler and file I/O must not block the event loop
+            await run_in_threadpool(self._finish, profile)
@@ -4,6 +4,11 @@ CHAT_SYSTEM_PROMPT = """You are a helpful AI assistant.
 Provide clear, accurate, and concise answers to user questions.
 If you don't know something, admit it rather than making up information."""
 
+SESSION_SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an AI assistant.
+Merge the previous summary with the new messages into one concise summary.
+Keep facts, decisions, names of documents or topics, and open questions the user may refer back to.
+Return only the summary text."""
+
 MULTIMODAL_SYSTEM_PROMPT = """You are a helpful assistant that can analyze images and answer questions about them.
 Provide detailed and accurate descriptions of what you see.
 If the image is unclear or you cannot determine something, say so."""
@@ -0,0 +1,38 @@
+from fastapi import APIRouter, HTTPException, Header, Depends, Query
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+import logging
+
+from config import settings
+from profiling import PROFILE_TOKEN_HEADER, is_authorized, list_profiles, read_profile
+
+logger = logging.getLogger(__name__)
+
+
+def require_admin_token(
+    x_profile_token: Optional[str] = Header(default=None, alias=PROFILE_TOKEN_HEADER)
+):
+    """Admin endpoints require the profiling token; they don't exist without one"""
+    if not settings.profiling_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Invalid or missing profiling token")
+
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin_token)])
+
+
+# Plain functions so the file reads run in the threadpool
+@router.get("/profiles")
+def get_profiles(limit: int = Query(default=20, ge=1, le=200)):
+    """List the most recent request profiles, newest first"""
+    return {"profiles": list_profiles(limit)}
+
+
+@router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+def get_profile(profile_id: str):
+    """Collapsed stacks of a profile (input for flamegraph.pl or speedscope)"""
+    collapsed = read_profile(profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(collapsed)
@@ -1,11 +1,21 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
+from starlette.concurrency import run_in_threadpool
 from langfuse.decorators import observe, langfuse_context
 from langfuse.openai import AzureOpenAI
+from typing import Optional
 import logging
+import time
 
 from config import settings
+from cache import get_cache, make_key
+from sessions import Turn, get_session_store, compact_session
+from tokens import estimate_tokens
+from deadlines import (
+    RequestContext, RequestCancelled, request_context, run_with_cancellation,
+    record_cancellation_metric
+)
 from schemas import QuestionRequest, AnswerResponse
-from prompts import CHAT_SYSTEM_PROMPT
+from prompts import CHAT_SYSTEM_PROMPT, SESSION_SUMMARY_PROMPT
 
 logger = logging.getLogger(__name__)
 
@@ -21,48 +31,182 @@ deployment_name = "gpt-5-mini"
 
 
 @observe()
-def ask_question(question: str) -> str:
-    """Ask a question and get an answer from the LLM"""
+def ask_question(
+    question: str,
+    history: Optional[list[dict]] = None,
+    ctx: Optional[RequestContext] = None
+) -> str:
+    """Ask a question and get an answer from the LLM
+    
+    Args:
+        question: The user's question
+        history: Earlier conversation messages (summary and recent turns)
+        ctx: Request context bounding the upstream call
+    """
+    
+    # Answers only depend on the question when there is no prior context
+    cache_key = None
+    if not history:
+        cache_key = make_key(settings.chat_model_name, CHAT_SYSTEM_PROMPT, question)
+        cached = get_cache().get("answers", cache_key)
+        if cached is not None:
+            logger.info("Chat answer served from cache")
+            return cached
     
     messages = [
         {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+        *(history or []),
         {"role": "user", "content": question}
     ]
     
     logger.info(f"Starting LLM call with {settings.chat_model_name}. Question: {question[:50]}...")
     
-    completion = azure_client.chat.completions.create(
+    request_options = {}
+    if ctx is not None:
+        ctx.check()
+        request_options["timeout"] = ctx.upstream_timeout()
+    
+    # Streamed so a cancelled request can stop generation between chunks
+    stream = azure_client.chat.completions.create(
         model=settings.chat_model_name,
-        messages=messages
+        messages=messages,
+        stream=True,
+        **request_options
     )
     
-    answer = completion.choices[0].message.content
+    parts = []
+    usage = None
+    chunks = iter(stream)
+    try:
+        for chunk in chunks:
+            if ctx is not None:
+                try:
+                    ctx.check()
+                except RequestCancelled:
+                    record_cancellation_metric("upstream_calls_cancelled")
+                    raise
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+    finally:
+        # Ending the iteration records the generation in Langfuse; closing the
+        # HTTP response (wrapped by Langfuse) makes the model stop generating
+        chunks.close()
+        getattr(stream, "response", stream).close()
     
-    logger.info(
-        f"LLM response received. "
-        f"Tokens: {completion.usage.prompt_tokens}/{completion.usage.completion_tokens}/{completion.usage.total_tokens} (in/out/total)"
-    )
+    answer = "".join(parts)
     
+    # Only reported by API versions that accept stream_options (not the default)
+    if usage is not None:
+        logger.info(
+            f"LLM response received. "
+            f"Tokens: {usage.prompt_tokens}/{usage.completion_tokens}/{usage.total_tokens} (in/out/total)"
+        )
+    else:
+        logger.info(f"LLM response received. Estimated output tokens: {estimate_tokens(answer)}")
+    
+    if cache_key is not None:
+        get_cache().set("answers", cache_key, answer)
     return answer
 
 
+@observe()
+def summarize_turns(previous_summary: str, turns: list[Turn], max_tokens: int) -> str:
+    """Merge older conversation turns into the running session summary
+    
+    The model is asked to stay within `max_tokens` (the caller also cuts the
+    result to it); an empty reply raises so the previous summary and turns
+    are kept.
+    """
+    
+    transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in turns)
+    content = (
+        f"Previous summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}\n\n"
+        f"Keep the summary under {max_tokens * 3 // 4} words."
+    )
+    
+    completion = azure_client.chat.completions.create(
+        model=settings.chat_model_name,
+        messages=[
+            {"role": "system", "content": SESSION_SUMMARY_PROMPT},
+            {"role": "user", "content": content}
+        ]
+    )
+    summary = completion.choices[0].message.content
+    if not summary:
+        raise ValueError(f"Empty summary (finish reason: {completion.choices[0].finish_reason})")
+    return summary
+
+
+def compact_chat_session(session_id: str) -> None:
+    """Background task: compact a session's history into its summary"""
+    compact_session(
+        get_session_store(),
+        session_id,
+        settings.session_history_token_budget,
+        summarize_turns
+    )
+    langfuse_context.flush()
+
+
 @router.post("/ask", response_model=AnswerResponse)
 @observe()
-async def ask(request: QuestionRequest):
-    """Ask a question and get an answer from the LLM"""
+async def ask(
+    request: QuestionRequest,
+    background_tasks: BackgroundTasks,
+    ctx: RequestContext = Depends(request_context)
+):
+    """Ask a question and get an answer from the LLM
+    
+    Pass the returned `session_id` with follow-up questions to continue the
+    conversation. History is kept within `session_history_token_budget` tokens;
+    older turns are summarized in the background.
+    """
     
     logger.info(f"New chat request received")
     logger.debug(f"Question: {request.question}")
     
     try:
-        answer = ask_question(request.question)
+        store = get_session_store()
+        budget = settings.session_history_token_budget
+        # Session stores may do blocking I/O and wait on locks; keep them off the event loop
+        session = await run_in_threadpool(store.get_or_create, request.session_id)
+        history = session.build_messages(budget)
+        
+        start_time = time.time()
+        answer = await run_with_cancellation(
+            ctx, ask_question, request.question, history, ctx, upstream=True
+        )
+        latency = time.time() - start_time
+        
+        def record_turns(latest):
+            latest.add_turn("user", request.question)
+            latest.add_turn("assistant", answer)
+            if latest.needs_compaction(budget):
+                latest.compacting_since = time.time()
+                background_tasks.add_task(compact_chat_session, latest.session_id)
+        
+        # Applied to the latest stored state so concurrent turns and
+        # compactions that finished during the LLM call are kept
+        session = await run_in_threadpool(
+            store.update, session.session_id, record_turns, create=True
+        )
+        
         langfuse_context.flush()
-        logger.info("Request completed successfully")
+        logger.info(
+            f"Request completed successfully. Session {session.session_id}: "
+            f"{len(history)} history messages, {session.history_tokens} history tokens, "
+            f"latency {latency:.2f}s"
+        )
         
         return AnswerResponse(
             question=request.question,
-            answer=answer
+            answer=answer,
+            session_id=session.session_id
         )
+    except RequestCancelled:
+        raise
     except Exception as e:
         logger.error(f"Error processing question: {str(e)}", exc_info=True)
         langfuse_context.flush()
@@ -1,14 +1,23 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
 from azure.ai.inference import ChatCompletionsClient
 from azure.ai.inference.models import SystemMessage, UserMessage, TextContentItem, ImageContentItem, ImageUrl
 from azure.core.credentials import AzureKeyCredential
 from langfuse import Langfuse
 from datetime import datetime
+from typing import Optional, Union
 import base64
 import logging
+import time
 import fitz  # PyMuPDF
 
 from config import settings
+from cache import get_cache, make_key
+from page_index import get_page_index
+from tokens import estimate_tokens
+from deadlines import (
+    RequestContext, RequestCancelled, request_context_with_timeout, run_with_cancellation,
+    record_cancellation_metric
+)
 from schemas import MultimodalResponse
 from prompts import MULTIMODAL_SYSTEM_PROMPT
 
@@ -29,40 +38,128 @@ langfuse = Langfuse(
 )
 
 
-def pdf_to_images(pdf_bytes: bytes, max_pages: int = 5) -> list[tuple[str, str]]:
+def open_pdf(pdf_bytes: bytes) -> tuple[fitz.Document, str]:
+    """Open a PDF once per request and hash its content for cache keys
+    
+    Returns:
+        Tuple of (open document, content hash); the caller closes the document
+    """
+    try:
+        return fitz.open(stream=pdf_bytes, filetype="pdf"), make_key(pdf_bytes)
+    except Exception as e:
+        logger.error(f"Error opening PDF: {e}")
+        raise HTTPException(status_code=400, detail=f"Failed to process PDF: {str(e)}")
+
+
+def select_pdf_pages(
+    doc: fitz.Document,
+    doc_hash: str,
+    question: str,
+    top_k: int
+) -> tuple[list[int], float]:
+    """Pick the pages most relevant to the question using a BM25 page index
+    
+    Args:
+        doc: Open PDF document
+        doc_hash: Content hash of the document (from `open_pdf`)
+        question: The user's question
+        top_k: Number of pages to select
+        
+    Returns:
+        Tuple of (0-based page numbers in document order, selection time in ms)
+    """
+    start_time = time.perf_counter()
+    try:
+        index = get_page_index(doc, doc_hash)
+    except Exception as e:
+        logger.error(f"Error indexing PDF: {e}")
+        raise HTTPException(status_code=400, detail=f"Failed to process PDF: {str(e)}")
+    
+    pages = index.top_pages(question, top_k)
+    selection_ms = (time.perf_counter() - start_time) * 1000
+    logger.info(
+        f"Selected pages {[page + 1 for page in pages]} of {index.page_count} "
+        f"in {selection_ms:.1f}ms"
+    )
+    return pages, selection_ms
+
+
+def pdf_to_images(
+    pdf: Union[bytes, fitz.Document],
+    max_pages: int = 5,
+    pages: Optional[list[int]] = None,
+    ctx: Optional[RequestContext] = None,
+    doc_hash: Optional[str] = None
+) -> list[tuple[str, str]]:
     """Convert PDF pages to base64-encoded images
     
     Args:
-        pdf_bytes: PDF file content as bytes
-        max_pages: Maximum number of pages to process
+        pdf: PDF file content as bytes, or a document opened with `open_pdf`
+        max_pages: Maximum number of pages to process (from the start)
+        pages: Specific 0-based page numbers to render instead of the first pages
+        ctx: Request context; rendering stops once the request is cancelled
+        doc_hash: Content hash, required when passing an open document
         
     Returns:
         List of tuples (base64_image_data, image_format)
     """
+    owns_doc = isinstance(pdf, bytes)
+    doc, doc_hash = open_pdf(pdf) if owns_doc else (pdf, doc_hash)
     try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        cache = get_cache()
         images = []
         
-        for page_num in range(min(len(doc), max_pages)):
+        if pages is None:
+            pages = range(min(len(doc), max_pages))
+        
+        for page_num in pages:
+            if ctx is not None:
+                try:
+                    ctx.check()
+                except RequestCancelled:
+                    record_cancellation_metric("pages_skipped.render", len(pages) - len(images))
+                    raise
+            cache_key = make_key(doc_hash, page_num, 2)
+            cached = cache.get("pages", cache_key)
+            if cached is not None:
+                images.append(tuple(cached))
+                continue
             page = doc[page_num]
             # Render page at 2x resolution for better quality
             pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
             img_data = pix.tobytes("png")
             img_base64 = base64.b64encode(img_data).decode("utf-8")
             images.append((img_base64, "png"))
+            cache.set("pages", cache_key, images[-1])
             
-        doc.close()
         logger.info(f"Converted {len(images)} pages from PDF")
         return images
         
+    except (RequestCancelled, HTTPException):
+        raise
     except Exception as e:
         logger.error(f"Error converting PDF to images: {e}")
         raise HTTPException(status_code=400, detail=f"Failed to process PDF: {str(e)}")
+    finally:
+        if owns_doc:
+            doc.close()
 
 
-def ask_multimodal_question(question: str, image_data: str, image_format: str) -> tuple[str, dict]:
+def ask_multimodal_question(
+    question: str,
+    image_data: str,
+    image_format: str,
+    ctx: Optional[RequestContext] = None
+) -> tuple[str, dict]:
     """Ask a question about an image using the multimodal model"""
     
+    cache_key = make_key(settings.multimodal_model_name, MULTIMODAL_SYSTEM_PROMPT, question, image_data)
+    cached = get_cache().get("answers", cache_key)
+    if cached is not None:
+        logger.info("Multimodal answer served from cache")
+        answer, _ = cached
+        return answer, {"input": 0, "output": 0, "total": 0}
+    
     trace = langfuse.trace(
         name="multimodal_question",
         metadata={"model": settings.multimodal_model_name}
@@ -71,8 +168,14 @@ def ask_multimodal_question(question: str, image_data: str, image_format: str) -
     data_url = ImageUrl(url=f"data:image/{image_format};base64,{image_data}")
     
     logger.info(f"Starting multimodal LLM call with {settings.multimodal_model_name}. Question: {question[:50]}...")
+    request_options = {}
+    if ctx is not None:
+        ctx.check()
+        request_options["read_timeout"] = ctx.upstream_timeout()
+    
     start_time = datetime.now()
     
+    # Streamed so a cancelled request can stop generation between updates
     response = client.complete(
         messages=[
             SystemMessage(MULTIMODAL_SYSTEM_PROMPT),
@@ -81,16 +184,39 @@ def ask_multimodal_question(question: str, image_data: str, image_format: str) -
                 ImageContentItem(image_url=data_url)
             ]),
         ],
+        stream=True,
+        **request_options
     )
     
+    parts = []
+    usage = None
+    try:
+        for update in response:
+            if ctx is not None:
+                try:
+                    ctx.check()
+                except RequestCancelled:
+                    record_cancellation_metric("upstream_calls_cancelled")
+                    raise
+            if update.usage:
+                usage = {
+                    "input": update.usage.prompt_tokens,
+                    "output": update.usage.completion_tokens,
+                    "total": update.usage.total_tokens
+                }
+            if update.choices and update.choices[0].delta.content:
+                parts.append(update.choices[0].delta.content)
+    finally:
+        # Closing the connection makes the model stop generating (and billing)
+        response.close()
+    
     end_time = datetime.now()
-    answer = response.choices[0].message.content
+    answer = "".join(parts)
     
-    usage = {
-        "input": response.usage.prompt_tokens,
-        "output": response.usage.completion_tokens,
-        "total": response.usage.total_tokens
-    }
+    if usage is None:
+        # Not every deployment reports usage on streamed responses
+        output_tokens = estimate_tokens(answer)
+        usage = {"input": 0, "output": output_tokens, "total": output_tokens}
     
     langfuse.generation(
         name="multimodal_completion",
@@ -119,21 +245,27 @@ def ask_multimodal_question(question: str, image_data: str, image_format: str) -
         f"Latency: {latency:.2f}s"
     )
     
+    get_cache().set("answers", cache_key, [answer, usage])
     return answer, usage
 
 
 @router.post("/ask-with-image", response_model=MultimodalResponse)
 async def ask_multimodal_with_file(
     question: str = Form(..., description="Your question about the image or PDF"),
-    image: UploadFile = File(..., description="Image or PDF file to analyze")
+    image: UploadFile = File(..., description="Image or PDF file to analyze"),
+    ctx: RequestContext = Depends(request_context_with_timeout("multimodal_request_timeout_seconds"))
 ):
     """Ask a question about an image or PDF document
     
     Supports:
     - Images: JPEG, PNG, GIF, WEBP
-    - PDFs: Converts first 5 pages to images and analyzes them
+    - PDFs: Ranks pages by relevance to the question (BM25 over the page
+      text) and analyzes the top `pdf_max_pages` pages
     
-    For PDFs with multiple pages, all pages are analyzed together.
+    For PDFs with multiple pages, all selected pages are analyzed together.
+    Rendering and remaining page calls stop when the client disconnects or
+    the `X-Request-Timeout` deadline passes (default
+    `multimodal_request_timeout_seconds`, since PDFs need one call per page).
     """
     
     logger.info(f"New multimodal request. File: {image.filename} ({image.content_type})")
@@ -143,6 +275,8 @@ async def ask_multimodal_with_file(
         file_bytes = await image.read()
         file_type = "image"
         pages_processed = None
+        selected_pages = None
+        page_selection_ms = None
         
         # Check if it's a PDF
         is_pdf = (
@@ -154,20 +288,53 @@ async def ask_multimodal_with_file(
             logger.info("Processing PDF file")
             file_type = "pdf"
             
-            pdf_images = pdf_to_images(file_bytes, max_pages=5)
+            # Open and hash once; page selection and rendering share the document
+            doc, doc_hash = await run_with_cancellation(ctx, open_pdf, file_bytes)
+            abandoned = False
+            try:
+                pages, page_selection_ms = await run_with_cancellation(
+                    ctx, select_pdf_pages, doc, doc_hash, question, settings.pdf_max_pages
+                )
+                selected_pages = [page + 1 for page in pages]
+                pdf_images = await run_with_cancellation(
+                    ctx, pdf_to_images, doc, pages=pages, ctx=ctx, doc_hash=doc_hash
+                )
+            except RequestCancelled:
+                # An abandoned worker may still be using the document; it is
+                # closed when garbage collected instead
+                abandoned = True
+                raise
+            finally:
+                if not abandoned:
+                    doc.close()
             pages_processed = len(pdf_images)
             
             if len(pdf_images) == 1:
                 image_data, image_format = pdf_images[0]
-                answer, usage = ask_multimodal_question(question, image_data, image_format)
+                answer, usage = await run_with_cancellation(
+                    ctx, ask_multimodal_question, question, image_data, image_format, ctx,
+                    upstream=True
+                )
             else:
                 logger.info(f"Processing multi-page PDF with {len(pdf_images)} pages")
                 all_answers = []
                 total_usage = {"input": 0, "output": 0, "total": 0}
                 
-                for idx, (img_data, img_format) in enumerate(pdf_images, 1):
+                for done, (idx, (img_data, img_format)) in enumerate(zip(selected_pages, pdf_images)):
                     page_question = f"Page {idx} of the document: {question}"
-                    answer, usage = ask_multimodal_question(page_question, img_data, img_format)
+                    started = done
+                    try:
+                        ctx.check()
+                        started = done + 1
+                        answer, usage = await run_with_cancellation(
+                            ctx, ask_multimodal_question, page_question, img_data, img_format, ctx,
+                            upstream=True
+                        )
+                    except RequestCancelled:
+                        # A page whose call was in flight counts as a cancelled or
+                        # abandoned upstream call, not as skipped
+                        record_cancellation_metric("pages_skipped.answer", len(pdf_images) - started)
+                        raise
                     all_answers.append(f"**Page {idx}:**\n{answer}")
                     
                     total_usage["input"] += usage["input"]
@@ -193,7 +360,10 @@ async def ask_multimodal_with_file(
                 elif "webp" in image.content_type:
                     image_format = "webp"
             
-            answer, usage = ask_multimodal_question(question, image_data, image_format)
+            answer, usage = await run_with_cancellation(
+                ctx, ask_multimodal_question, question, image_data, image_format, ctx,
+                upstream=True
+            )
         
         langfuse.flush()
         logger.info("Request completed successfully")
@@ -203,8 +373,12 @@ async def ask_multimodal_with_file(
             answer=answer,
             usage=usage,
             file_type=file_type,
-            pages_processed=pages_processed
+            pages_processed=pages_processed,
+            selected_pages=selected_pages,
+            page_selection_ms=page_selection_ms
         )
+    except RequestCancelled:
+        raise
     except HTTPException:
         raise
     except Exception as e:
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
 from typing import Optional, Tuple
 from langfuse.decorators import observe
 from langfuse import Langfuse
@@ -8,6 +8,12 @@ import json
 import logging
 
 from config import settings
+from cache import get_cache, make_key
+from tokens import estimate_tokens
+from deadlines import (
+    RequestContext, RequestCancelled, request_context, run_with_cancellation,
+    record_cancellation_metric
+)
 from schemas import RouterResponse, FinalResponse
 from prompts import ROUTER_SYSTEM_PROMPT
 
@@ -30,10 +36,208 @@ def get_claude_client():
     )
 
 
+ROUTER_TOOL = {
+    "name": "route_query",
+    "description": "Record the selected agent and the PII-sanitized query",
+    "input_schema": RouterResponse.model_json_schema()
+}
+
+# Output budget: JSON envelope plus the sanitized query, which is about as long
+# as the original (PII placeholders can make it slightly longer). The cap only
+# bounds runaway output; unused tokens are not billed.
+ROUTER_MIN_OUTPUT_TOKENS = 48
+ROUTER_MAX_OUTPUT_TOKENS = 4096
+
+
+def router_output_budget(query: str) -> int:
+    """max_tokens for a routing call, sized to the query length"""
+    budget = ROUTER_MIN_OUTPUT_TOKENS + 2 * estimate_tokens(query)
+    return min(budget, ROUTER_MAX_OUTPUT_TOKENS)
+
+
+class JsonObjectScanner:
+    """Detect when a streamed top-level JSON object is complete
+    
+    Text before the first ``{`` (e.g. a markdown fence) is ignored.
+    """
+    
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+    
+    def feed(self, chunk: str) -> bool:
+        """Consume a chunk; returns True once the object has been closed"""
+        for char in chunk:
+            if self.complete:
+                break
+            if not self.started:
+                if char != "{":
+                    continue
+                self.started = True
+            self.buffer.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                self.complete = self.depth == 0
+        return self.complete
+    
+    @property
+    def text(self) -> str:
+        return "".join(self.buffer)
+
+
+def _log_router_generation(name, trace, user_message, output, usage, max_tokens, start_time, end_time):
+    langfuse.generation(
+        name=name,
+        model=settings.claude_deployment_name,
+        model_parameters={"max_tokens": max_tokens, "tool_choice": ROUTER_TOOL["name"]},
+        input=[
+            {"role": "user", "content": user_message}
+        ],
+        output=output,
+        usage={
+            "input": usage["input"],
+            "output": usage["output"],
+            "total": usage["total"],
+            "unit": "TOKENS"
+        },
+        start_time=start_time,
+        end_time=end_time,
+        trace_id=trace.id
+    )
+
+
+def _request_options(ctx: Optional[RequestContext]) -> dict:
+    """Per-call SDK options bounding an upstream call by the request deadline"""
+    if ctx is None:
+        return {}
+    ctx.check()
+    return {"timeout": ctx.upstream_timeout()}
+
+
+def _stream_classification(
+    claude_client,
+    user_message: str,
+    max_tokens: int,
+    ctx: Optional[RequestContext] = None
+) -> Tuple[str, dict, bool]:
+    """Stream a forced tool call and stop as soon as its JSON input is complete
+    
+    The stream is also closed early if the request is cancelled.
+    
+    Returns:
+        Tuple of (raw_json, usage_dict, complete)
+    """
+    scanner = JsonObjectScanner()
+    input_tokens = 0
+    output_tokens = 0
+    
+    with claude_client.messages.stream(
+        model=settings.claude_deployment_name,
+        messages=[
+            {"role": "user", "content": user_message}
+        ],
+        tools=[ROUTER_TOOL],
+        tool_choice={"type": "tool", "name": ROUTER_TOOL["name"]},
+        max_tokens=max_tokens,
+        **_request_options(ctx)
+    ) as stream:
+        for event in stream:
+            if ctx is not None:
+                try:
+                    ctx.check()
+                except RequestCancelled:
+                    record_cancellation_metric("upstream_calls_cancelled")
+                    raise
+            if event.type == "message_start":
+                input_tokens = event.message.usage.input_tokens
+                output_tokens = event.message.usage.output_tokens
+            elif event.type == "message_delta":
+                output_tokens = event.usage.output_tokens
+            elif event.type == "content_block_delta":
+                if event.delta.type == "input_json_delta":
+                    chunk = event.delta.partial_json
+                elif event.delta.type == "text_delta":
+                    chunk = event.delta.text
+                else:
+                    continue
+                if scanner.feed(chunk):
+                    # Leaving the context manager closes the connection, so the
+                    # model stops generating (and billing) right here
+                    break
+    
+    if scanner.complete:
+        output_tokens = max(output_tokens, estimate_tokens(scanner.text))
+    usage = {
+        "input": input_tokens,
+        "output": output_tokens,
+        "total": input_tokens + output_tokens
+    }
+    return scanner.text, usage, scanner.complete
+
+
+def _repair_classification(
+    claude_client,
+    user_message: str,
+    raw: str,
+    error: str,
+    max_tokens: int,
+    ctx: Optional[RequestContext] = None
+) -> Tuple[RouterResponse, str, dict]:
+    """Single repair pass after an unusable router reply"""
+    repair_message = (
+        f"{user_message}\n\n"
+        f"Your previous reply could not be used ({error}):\n{raw or '(empty)'}\n\n"
+        f"Call {ROUTER_TOOL['name']} again with a corrected classification."
+    )
+    message = claude_client.messages.create(
+        model=settings.claude_deployment_name,
+        messages=[
+            {"role": "user", "content": repair_message}
+        ],
+        tools=[ROUTER_TOOL],
+        tool_choice={"type": "tool", "name": ROUTER_TOOL["name"]},
+        max_tokens=max_tokens,
+        **_request_options(ctx)
+    )
+    usage = {
+        "input": message.usage.input_tokens,
+        "output": message.usage.output_tokens,
+        "total": message.usage.input_tokens + message.usage.output_tokens
+    }
+    tool_input = next(
+        (block.input for block in message.content if block.type == "tool_use"),
+        None
+    )
+    if tool_input is None:
+        raise ValueError(f"No {ROUTER_TOOL['name']} call in repair reply")
+    return RouterResponse(**tool_input), json.dumps(tool_input), usage
+
+
 @observe()
-def classify_and_sanitize(query: str) -> Tuple[RouterResponse, dict]:
+def classify_and_sanitize(query: str, ctx: Optional[RequestContext] = None) -> Tuple[RouterResponse, dict]:
     """Classify query and remove PII using Claude
     
+    The model is forced to answer through the ``route_query`` tool, whose
+    schema matches ``RouterResponse``. The reply is streamed and the stream is
+    closed as soon as the JSON object is complete. An unusable reply gets one
+    automatic repair pass before failing. With a request context, the calls
+    stop once the request is cancelled.
+    
     Returns:
         Tuple of (RouterResponse, usage_dict)
     """
@@ -42,53 +246,30 @@ def classify_and_sanitize(query: str) -> Tuple[RouterResponse, dict]:
     
     logger.info(f"Routing query: {query[:50]}...")
     
+    cache_key = make_key(settings.claude_deployment_name, ROUTER_SYSTEM_PROMPT, query)
+    cached = get_cache().get("router", cache_key)
+    if cached is not None:
+        logger.info("Router classification served from cache")
+        return RouterResponse(**cached), {"input": 0, "output": 0, "total": 0}
+    
     # Create Langfuse trace for tracking
     trace = langfuse.trace(
         name="router_classification",
         metadata={"model": settings.claude_deployment_name}
     )
     
+    max_tokens = router_output_budget(query)
     start_time = datetime.now()
     
     claude_client = get_claude_client()
-    message = claude_client.messages.create(
-        model=settings.claude_deployment_name,
-        messages=[
-            {"role": "user", "content": user_message}
-        ],
-        max_tokens=1024
-    )
+    response_text, usage, complete = _stream_classification(claude_client, user_message, max_tokens, ctx)
     
     end_time = datetime.now()
-    
-    response_text = message.content[0].text
     logger.debug(f"Router raw response: {response_text}")
     
-    # Extract usage information
-    usage = {
-        "input": message.usage.input_tokens,
-        "output": message.usage.output_tokens,
-        "total": message.usage.input_tokens + message.usage.output_tokens
-    }
-    
-    # Log usage to Langfuse
-    langfuse.generation(
-        name="claude_router_completion",
-        model=settings.claude_deployment_name,
-        model_parameters={"max_tokens": 1024},
-        input=[
-            {"role": "user", "content": user_message}
-        ],
-        output=response_text,
-        usage={
-            "input": usage["input"],
-            "output": usage["output"],
-            "total": usage["total"],
-            "unit": "TOKENS"
-        },
-        start_time=start_time,
-        end_time=end_time,
-        trace_id=trace.id
+    _log_router_generation(
+        "claude_router_completion", trace, user_message, response_text,
+        usage, max_tokens, start_time, end_time
     )
     
     latency = (end_time - start_time).total_seconds()
@@ -98,26 +279,41 @@ def classify_and_sanitize(query: str) -> Tuple[RouterResponse, dict]:
         f"Latency: {latency:.2f}s"
     )
     
-    # Strip markdown code blocks if present
-    if response_text.strip().startswith("```"):
-        lines = response_text.strip().split("\n")
-        response_text = "\n".join(lines[1:-1])
-        logger.debug(f"Cleaned response: {response_text}")
-    
     try:
-        response_data = json.loads(response_text)
-        return RouterResponse(**response_data), usage
-    except (json.JSONDecodeError, ValueError) as e:
-        logger.error(f"Failed to parse router response: {e}")
-        logger.error(f"Raw response: {response_text}")
-        raise HTTPException(status_code=500, detail="Failed to classify query")
+        if not complete:
+            raise ValueError(f"Reply truncated at max_tokens={max_tokens}")
+        classification = RouterResponse(**json.loads(response_text))
+    except (json.JSONDecodeError, ValueError, TypeError) as e:
+        logger.warning(f"Unusable router response, attempting repair: {e}")
+        logger.debug(f"Raw response: {response_text}")
+        repair_tokens = min(2 * max_tokens, ROUTER_MAX_OUTPUT_TOKENS)
+        repair_start = datetime.now()
+        try:
+            classification, repaired_text, repair_usage = _repair_classification(
+                claude_client, user_message, response_text, str(e), repair_tokens, ctx
+            )
+        except RequestCancelled:
+            raise
+        except Exception as repair_error:
+            logger.error(f"Failed to parse router response after repair: {repair_error}")
+            raise HTTPException(status_code=500, detail="Failed to classify query")
+        _log_router_generation(
+            "claude_router_repair", trace, user_message, repaired_text,
+            repair_usage, repair_tokens, repair_start, datetime.now()
+        )
+        usage = {key: usage[key] + repair_usage[key] for key in usage}
+        logger.info("Router response repaired")
+    
+    get_cache().set("router", cache_key, classification.model_dump())
+    return classification, usage
 
 
 @router_api.post("/ask", response_model=FinalResponse)
 @observe()
 async def route_query(
     question: str = Form(..., description="Your question"),
-    image: Optional[UploadFile] = File(default=None)
+    image: Optional[UploadFile] = File(default=None),
+    ctx: RequestContext = Depends(request_context)
 ):
     """
     Single endpoint for query classification and PII redaction
@@ -143,7 +339,9 @@ async def route_query(
     
     try:
         # Step 1: Classify and sanitize
-        classification, usage = classify_and_sanitize(question)
+        classification, usage = await run_with_cancellation(
+            ctx, classify_and_sanitize, question, ctx, upstream=True
+        )
         
         logger.info(f"Classification result: agent={classification.agent}")
         logger.debug(f"Sanitized query: {classification.query}")
@@ -168,7 +366,7 @@ async def route_query(
             usage=usage
         )
             
-    except HTTPException:
+    except (HTTPException, RequestCancelled):
         raise
     except Exception as e:
         logger.error(f"Error in routing: {e}", exc_info=True)
@@ -6,12 +6,14 @@ from typing import Optional, Literal
 class QuestionRequest(BaseModel):
     """Request model for text-only questions"""
     question: str = Field(..., description="The question to ask the LLM")
+    session_id: Optional[str] = Field(default=None, description="Conversation to continue (omit to start a new one)")
 
 
 class AnswerResponse(BaseModel):
     """Response model for text-only questions"""
     question: str
     answer: str
+    session_id: Optional[str] = Field(default=None, description="Conversation ID to send with follow-up questions")
 
 
 class MultimodalResponse(BaseModel):
@@ -21,6 +23,8 @@ class MultimodalResponse(BaseModel):
     usage: dict
     file_type: str = Field(default="image", description="Type of file processed (image or pdf)")
     pages_processed: Optional[int] = Field(default=None, description="Number of pages processed for PDFs")
+    selected_pages: Optional[list[int]] = Field(default=None, description="1-based PDF page numbers selected as most relevant")
+    page_selection_ms: Optional[float] = Field(default=None, description="Time spent ranking PDF pages, in milliseconds")
 
 
 class RouterResponse(BaseModel):
@@ -0,0 +1,347 @@
+"""Server-side conversation sessions for the chat endpoint
+
+Sessions keep a running token count that is updated incrementally as turns
+are added, so building a prompt never re-tokenizes the whole history. When the
+history exceeds its token budget the oldest turns are folded into a running
+summary by a background compaction job; until that finishes, prompts simply
+include as many recent turns as fit in the budget. The summary may use at
+most half of the budget, so the most recent exchange always has room.
+
+Read-modify-write changes go through ``SessionStore.update`` so that
+concurrent requests and compaction jobs never overwrite each other's turns.
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import AbstractContextManager
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Optional
+import copy
+import logging
+import threading
+import time
+import uuid
+
+from cache import CacheBackend
+from tokens import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# Compaction jobs older than this are assumed to have died and may be retried
+COMPACTION_TIMEOUT_SECONDS = 120
+
+
+def summary_token_limit(token_budget: int) -> int:
+    """Share of the history budget the running summary may use"""
+    return token_budget // 2
+
+
+@dataclass
+class Turn:
+    """A single message in a conversation"""
+    seq: int
+    role: str
+    content: str
+    tokens: int
+
+
+@dataclass
+class ChatSession:
+    """Conversation state: a running summary plus the most recent turns"""
+    session_id: str
+    turns: list[Turn] = field(default_factory=list)
+    summary: str = ""
+    summary_tokens: int = 0
+    history_tokens: int = 0
+    next_seq: int = 0
+    compacting_since: Optional[float] = None
+    updated_at: float = field(default_factory=time.time)
+
+    def add_turn(self, role: str, content: str) -> None:
+        tokens = estimate_tokens(content)
+        self.turns.append(Turn(self.next_seq, role, content, tokens))
+        self.next_seq += 1
+        self.history_tokens += tokens
+        self.updated_at = time.time()
+
+    def build_messages(self, token_budget: int) -> list[dict]:
+        """History messages (summary first) that fit within ``token_budget``
+
+        The summary is cut to its share of the budget; recent turns fill the
+        rest, newest first.
+        """
+        messages = []
+        remaining = token_budget
+        if self.summary:
+            summary = self.summary
+            if self.summary_tokens > summary_token_limit(token_budget):
+                summary = truncate_to_tokens(summary, summary_token_limit(token_budget))
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary}"
+            })
+            remaining -= estimate_tokens(summary)
+
+        recent = []
+        for turn in reversed(self.turns):
+            if turn.tokens > remaining:
+                break
+            recent.append({"role": turn.role, "content": turn.content})
+            remaining -= turn.tokens
+        messages.extend(reversed(recent))
+        return messages
+
+    def needs_compaction(self, token_budget: int) -> bool:
+        if self.history_tokens + self.summary_tokens <= token_budget:
+            return False
+        if self.compacting_since is None:
+            return True
+        return time.time() - self.compacting_since > COMPACTION_TIMEOUT_SECONDS
+
+    def turns_to_compact(self, token_budget: int) -> list[Turn]:
+        """Oldest turns to fold into the summary, leaving half the budget for recent turns"""
+        target = token_budget // 2
+        remaining = self.history_tokens
+        selected = []
+        for turn in self.turns[:-1]:
+            if remaining <= target:
+                break
+            selected.append(turn)
+            remaining -= turn.tokens
+        return selected
+
+    def apply_summary(self, summary: str, through_seq: int, max_tokens: Optional[int] = None) -> None:
+        """Replace turns up to ``through_seq`` with ``summary``, cut to ``max_tokens``"""
+        kept = [turn for turn in self.turns if turn.seq > through_seq]
+        self.turns = kept
+        self.history_tokens = sum(turn.tokens for turn in kept)
+        if max_tokens is not None:
+            summary = truncate_to_tokens(summary, max_tokens)
+        self.summary = summary
+        self.summary_tokens = estimate_tokens(summary)
+        self.compacting_since = None
+        self.updated_at = time.time()
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ChatSession":
+        return cls(**{**data, "turns": [Turn(**turn) for turn in data["turns"]]})
+
+
+class SessionSaveError(Exception):
+    """Raised when a session could not be stored"""
+
+
+class SessionStore(ABC):
+    """Storage for chat sessions"""
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[ChatSession]: ...
+
+    @abstractmethod
+    def save(self, session: ChatSession) -> None: ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None: ...
+
+    @abstractmethod
+    def _locked(self, session_id: str) -> AbstractContextManager:
+        """Context manager serializing updates of one session"""
+
+    def close(self) -> None:
+        pass
+
+    def get_or_create(self, session_id: Optional[str] = None) -> ChatSession:
+        """Return the stored session, or a new one with a server-generated id
+
+        Unknown ids supplied by clients are never adopted, so a session id
+        cannot be chosen (and then shared) by a third party.
+        """
+        if session_id:
+            session = self.get(session_id)
+            if session is not None:
+                return session
+            logger.info("Unknown or expired session id, starting a new session")
+        return ChatSession(session_id=uuid.uuid4().hex)
+
+    def update(
+        self,
+        session_id: str,
+        fn: Callable[[ChatSession], None],
+        create: bool = False
+    ) -> Optional[ChatSession]:
+        """Apply ``fn`` to the latest stored session and save it, atomically
+
+        With ``create`` a missing session is started under ``session_id``
+        (only pass ids the server generated); otherwise returns None for it.
+        """
+        with self._locked(session_id):
+            session = self.get(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = ChatSession(session_id=session_id)
+            fn(session)
+            self.save(session)
+            return session
+
+
+class InMemorySessionStore(SessionStore):
+    """Per-process store bounded by session count (LRU) and idle TTL
+
+    Sessions are copied in and out so callers get the same value semantics
+    as with the shared cache store.
+    """
+
+    def __init__(self, max_sessions: int, ttl: float):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self.ttl and time.time() - session.updated_at > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return copy.deepcopy(session)
+
+    def save(self, session):
+        with self._lock:
+            self._sessions[session.session_id] = copy.deepcopy(session)
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _locked(self, session_id):
+        return self._update_lock
+
+
+class CacheSessionStore(SessionStore):
+    """Store sessions in a shared cache so every worker and replica sees them
+
+    The cache should be dedicated to sessions so that large entries of other
+    features (e.g. rendered PDF pages) cannot evict conversations.
+    """
+
+    namespace = "sessions"
+
+    def __init__(self, cache: CacheBackend, ttl: float):
+        self.cache = cache
+        self.ttl = ttl
+
+    def get(self, session_id):
+        data = self.cache.get(self.namespace, session_id)
+        return ChatSession.from_dict(data) if data is not None else None
+
+    def save(self, session):
+        if not self.cache.set(self.namespace, session.session_id, session.to_dict(), ttl=self.ttl or None):
+            logger.error(f"Could not store session {session.session_id} ({len(session.turns)} turns)")
+            raise SessionSaveError(
+                f"Session {session.session_id} was not stored (too large or cache unavailable)"
+            )
+
+    def delete(self, session_id):
+        self.cache.delete(self.namespace, session_id)
+
+    def _locked(self, session_id):
+        return self.cache.lock(f"{self.namespace}:{session_id}")
+
+    def close(self) -> None:
+        self.cache.close()
+
+
+def compact_session(
+    store: SessionStore,
+    session_id: str,
+    token_budget: int,
+    summarize: Callable[[str, list[Turn], int], str]
+) -> None:
+    """Fold the oldest turns of a session into its summary
+
+    ``summarize(previous_summary, turns, max_tokens)`` produces the new
+    summary, which is cut to ``max_tokens`` if the model overshoots. Turns
+    added while it runs are preserved because only turns up to the last
+    summarized sequence number are dropped.
+    """
+    max_tokens = summary_token_limit(token_budget)
+
+    def finish(session: ChatSession) -> None:
+        session.compacting_since = None
+        if session.summary_tokens > max_tokens:
+            session.apply_summary(session.summary, through_seq=-1, max_tokens=max_tokens)
+
+    session = store.get(session_id)
+    if session is None:
+        return
+    turns = session.turns_to_compact(token_budget)
+    if not turns:
+        store.update(session_id, finish)
+        return
+
+    # Summarize outside the lock; the LLM call can take several seconds
+    start_time = time.time()
+    try:
+        summary = summarize(session.summary, turns, max_tokens)
+    except Exception as e:
+        logger.error(f"Session compaction failed for {session_id}: {e}", exc_info=True)
+        store.update(session_id, finish)
+        return
+
+    session = store.update(
+        session_id,
+        lambda latest: latest.apply_summary(summary, through_seq=turns[-1].seq, max_tokens=max_tokens)
+    )
+    if session is None:
+        return
+    logger.info(
+        f"Compacted {len(turns)} turns of session {session_id} in {time.time() - start_time:.2f}s. "
+        f"History tokens: {session.history_tokens}, summary tokens: {session.summary_tokens}"
+    )
+
+
+_store: Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Return the process-wide session store selected by ``settings.session_store``"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from config import settings
+                if settings.session_store == "cache":
+                    if settings.cache_backend == "none":
+                        raise ValueError(
+                            "session_store=cache requires a cache backend, but cache_backend=none; "
+                            "use session_store=memory or configure a cache backend"
+                        )
+                    from cache import create_cache
+                    cache = create_cache(
+                        settings.cache_backend,
+                        max_bytes=settings.session_cache_max_bytes,
+                        default_ttl=settings.session_ttl_seconds or None,
+                        shm_path=settings.session_cache_shm_path,
+                        redis_url=settings.session_cache_redis_url or settings.cache_redis_url,
+                        key_prefix="lego-case-sessions"
+                    )
+                    _store = CacheSessionStore(cache, settings.session_ttl_seconds)
+                elif settings.session_store == "memory":
+                    _store = InMemorySessionStore(
+                        settings.session_max_sessions, settings.session_ttl_seconds
+                    )
+                else:
+                    raise ValueError(f"Unknown session store: {settings.session_store}")
+                logger.info(f"Session store: {settings.session_store}")
+    return _store
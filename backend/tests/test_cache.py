@@ -0,0 +1,191 @@
+"""Unit tests for the shared cache backends"""
+import os
+import pytest
+import socket
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+backend_path = Path(__file__).parent.parent
+sys.path.insert(0, str(backend_path))
+
+from cache import InProcessLRUCache, SharedMemoryCache, RedisCache, make_key, serialize
+
+
+@pytest.fixture(params=["memory", "shm"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        backend = InProcessLRUCache(max_bytes=10_000)
+    else:
+        backend = SharedMemoryCache(str(tmp_path / "cache.sqlite3"), max_bytes=10_000)
+    yield backend
+    backend.close()
+
+
+@pytest.mark.unit
+def test_cache_roundtrip_and_stats(cache):
+    """Values survive serialization and hits/misses are counted per namespace"""
+    assert cache.get("router", "missing") is None
+    assert cache.set("router", "key", {"agent": "qa_agent", "query": "hi"})
+    assert cache.get("router", "key") == {"agent": "qa_agent", "query": "hi"}
+
+    stats = cache.stats()
+    assert stats["router"]["hits"] == 1
+    assert stats["router"]["misses"] == 1
+    assert stats["router"]["entries"] == 1
+    assert "answers" not in stats
+
+
+@pytest.mark.unit
+def test_cache_ttl_expiry(cache):
+    """Entries are not returned once their TTL has passed"""
+    cache.set("answers", "key", "value", ttl=0.05)
+    assert cache.get("answers", "key") == "value"
+    time.sleep(0.1)
+    assert cache.get("answers", "key") is None
+
+
+@pytest.mark.unit
+def test_cache_byte_budget_evicts_lru(cache):
+    """Least recently used entries are evicted to stay within the byte budget"""
+    value = "x" * 3_000
+    size = len(serialize(value))
+    for idx in range(3):
+        cache.set("pages", str(idx), value)
+        time.sleep(0.01)
+    cache.get("pages", "0")
+    cache.set("pages", "3", value)
+
+    assert cache.get("pages", "0") == value
+    assert cache.get("pages", "1") is None
+    stats = cache.stats()["pages"]
+    assert stats["evictions"] >= 1
+    assert stats["bytes"] <= 10_000
+    assert stats["bytes"] == stats["entries"] * size
+
+
+@pytest.mark.unit
+def test_cache_rejects_oversized_values(cache):
+    assert not cache.set("pages", "big", "x" * 20_000)
+    assert cache.get("pages", "big") is None
+
+
+@pytest.mark.unit
+def test_cache_rejects_values_that_are_not_json(cache):
+    assert not cache.set("pages", "bytes", b"raw")
+    assert cache.get("pages", "bytes") is None
+
+
+@pytest.mark.unit
+def test_cache_drops_unreadable_entries(cache):
+    """Entries that fail to deserialize are deleted and reported as misses"""
+    cache._set("sessions", "stale", b"\x80\x05not json", None)
+
+    assert cache.get("sessions", "stale", default="fallback") == "fallback"
+    assert cache._get("sessions", "stale") is None
+    assert cache.stats()["sessions"]["misses"] == 1
+
+
+@pytest.mark.unit
+def test_cache_lock_is_exclusive_until_released(cache):
+    with cache.lock("session:a"):
+        with pytest.raises(TimeoutError):
+            with cache.lock("session:a", timeout=0.05):
+                pass
+        with cache.lock("session:b", timeout=0.05):
+            pass
+    with cache.lock("session:a", timeout=0.05):
+        pass
+
+
+@pytest.mark.unit
+def test_cache_clear_namespace(cache):
+    cache.set("router", "a", 1)
+    cache.set("answers", "a", 2)
+    cache.clear("router")
+    assert cache.get("router", "a") is None
+    assert cache.get("answers", "a") == 2
+
+
+@pytest.mark.unit
+def test_shared_memory_cache_is_shared_between_instances(tmp_path):
+    """Two instances on the same path (e.g. two workers) see each other's writes"""
+    path = str(tmp_path / "cache.sqlite3")
+    worker_a = SharedMemoryCache(path, max_bytes=10_000)
+    worker_b = SharedMemoryCache(path, max_bytes=10_000)
+    worker_a.set("router", "key", "value")
+    assert worker_b.get("router", "key") == "value"
+
+
+@pytest.mark.unit
+def test_shared_memory_cache_stats_are_shared_between_instances(tmp_path):
+    """Counters are stored in the database, so every worker reports the same totals"""
+    path = str(tmp_path / "cache.sqlite3")
+    worker_a = SharedMemoryCache(path, max_bytes=10_000)
+    worker_b = SharedMemoryCache(path, max_bytes=10_000)
+    worker_a.set("router", "key", "value")
+    worker_b.get("router", "key")
+    worker_b.get("router", "other")
+    worker_b.flush_stats()
+
+    for worker in (worker_a, worker_b):
+        stats = worker.stats()["router"]
+        assert (stats["sets"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+
+@pytest.mark.unit
+def test_make_key_is_unambiguous():
+    assert make_key("ab", "c") != make_key("a", "bc")
+    assert make_key(b"bytes") == make_key(b"bytes")
+
+
+@pytest.mark.unit
+def test_redis_usage_falls_back_when_probe_drops_connection(monkeypatch):
+    """A server closing the connection on MEMORY USAGE is treated as not supporting it"""
+    cache = RedisCache("redis://localhost:1/0", max_bytes=10_000)
+    commands = []
+
+    def fake_pipeline(batch):
+        commands.extend(args[0] for args in batch)
+        if batch[0][0] == b"MEMORY":
+            raise ConnectionError("Redis connection closed")
+        return [7 for _ in batch]
+
+    monkeypatch.setattr(cache, "_pipeline", fake_pipeline)
+    monkeypatch.setattr(cache, "_scan", lambda pattern: iter([cache._key("router", "a")]))
+
+    assert cache._usage() == {"router": (7, 1)}
+    assert cache._usage() == {"router": (7, 1)}
+    assert commands == [b"MEMORY", b"STRLEN", b"STRLEN"]
+
+
+@pytest.mark.integration
+def test_redis_cache_roundtrip():
+    """Requires a Redis-protocol server at CACHE_REDIS_URL (default localhost:6379)"""
+    url = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+    parsed = urlparse(url)
+    try:
+        socket.create_connection((parsed.hostname, parsed.port or 6379), timeout=0.5).close()
+    except OSError:
+        pytest.skip(f"No Redis server at {url}")
+
+    prefix = f"lego-case-test-{os.getpid()}"
+    cache = RedisCache(url, max_bytes=10_000, key_prefix=prefix)
+    other_worker = RedisCache(url, max_bytes=10_000, key_prefix=prefix)
+    cache.clear()
+    cache.set("router", "key", {"agent": "irrelevant"}, ttl=5)
+    assert other_worker.get("router", "key") == {"agent": "irrelevant"}
+    other_worker.flush_stats()
+
+    stats = cache.stats()["router"]
+    assert stats["entries"] == 1
+    assert stats["bytes"] > 0
+    assert (stats["sets"], stats["hits"]) == (1, 1)
+
+    cache.clear("router")
+    assert cache.get("router", "key") is None
+    keys = list(cache._scan(f"{cache.key_prefix}:*"))
+    cache._execute(b"DEL", *keys)
+    cache.close()
+    other_worker.close()
@@ -0,0 +1,81 @@
+"""Unit tests for request deadlines and cancellation"""
+import asyncio
+import pytest
+import sys
+import time
+from pathlib import Path
+
+backend_path = Path(__file__).parent.parent
+sys.path.insert(0, str(backend_path))
+
+from config import settings
+from deadlines import (
+    RequestContext, RequestCancelled, parse_request_timeout, run_with_cancellation,
+    cancellation_stats
+)
+
+
+def _context(timeout: float) -> RequestContext:
+    return RequestContext(endpoint="/test", timeout=timeout, deadline=time.monotonic() + timeout)
+
+
+@pytest.mark.unit
+def test_parse_request_timeout():
+    assert parse_request_timeout("2.5") == 2.5
+    assert parse_request_timeout(None) == settings.request_timeout_seconds
+    assert parse_request_timeout("-1") == settings.request_timeout_seconds
+    assert parse_request_timeout("soon") == settings.request_timeout_seconds
+    assert parse_request_timeout("100000") == settings.request_timeout_max_seconds
+    assert parse_request_timeout(None, default=180.0) == 180.0
+    assert parse_request_timeout("2.5", default=180.0) == 2.5
+
+
+@pytest.mark.unit
+def test_run_with_cancellation_returns_result():
+    ctx = _context(5)
+
+    result = asyncio.run(run_with_cancellation(ctx, lambda x: x * 2, 21))
+
+    assert result == 42
+    assert not ctx.cancelled
+
+
+@pytest.mark.unit
+def test_run_with_cancellation_stops_at_deadline():
+    """The caller gets control back at the deadline and the worker stops at its next check"""
+    ctx = _context(0.3)
+    steps = []
+
+    def work():
+        for step in range(10):
+            ctx.check()
+            steps.append(step)
+            time.sleep(0.1)
+
+    before = cancellation_stats().get("requests_cancelled.deadline", 0)
+    start = time.monotonic()
+    with pytest.raises(RequestCancelled) as exc_info:
+        asyncio.run(run_with_cancellation(ctx, work))
+    elapsed = time.monotonic() - start
+    time.sleep(0.2)
+
+    assert exc_info.value.status_code == 504
+    assert elapsed < 0.6
+    assert len(steps) < 6
+    assert cancellation_stats()["requests_cancelled.deadline"] == before + 1
+
+
+@pytest.mark.unit
+def test_only_upstream_work_counts_as_abandoned_upstream_call():
+    """Abandoning local work such as PDF rendering is not an abandoned model call"""
+    def slow():
+        time.sleep(0.3)
+
+    before = cancellation_stats().get("upstream_calls_abandoned", 0)
+    with pytest.raises(RequestCancelled):
+        asyncio.run(run_with_cancellation(_context(0.05), slow))
+    assert cancellation_stats().get("upstream_calls_abandoned", 0) == before
+
+    with pytest.raises(RequestCancelled):
+        asyncio.run(run_with_cancellation(_context(0.05), slow, upstream=True))
+    assert cancellation_stats()["upstream_calls_abandoned"] == before + 1
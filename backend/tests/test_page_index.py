@@ -0,0 +1,57 @@
+"""Unit tests for relevance-ranked PDF page selection"""
+import pytest
+import sys
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+backend_path = Path(__file__).parent.parent
+sys.path.insert(0, str(backend_path))
+
+from page_index import PageIndex, build_page_index
+
+
+@pytest.fixture
+def handbook_pdf():
+    """60-page document where only page 40 mentions parental leave"""
+    doc = fitz.open()
+    for page_num in range(1, 61):
+        page = doc.new_page()
+        text = f"Employee handbook page {page_num}. General office guidelines and procedures."
+        if page_num == 40:
+            text += " Parental leave: employees receive 16 weeks of paid parental leave."
+        page.insert_text((72, 72), text)
+    yield doc
+    doc.close()
+
+
+@pytest.mark.unit
+def test_top_pages_finds_relevant_page_deep_in_document(handbook_pdf):
+    index = build_page_index(handbook_pdf)
+
+    pages = index.top_pages("How many weeks of parental leave do we get?", k=3)
+
+    assert index.page_count == 60
+    assert pages == [39]
+
+
+@pytest.mark.unit
+def test_top_pages_falls_back_to_first_pages_without_matches():
+    index = PageIndex.from_texts(["alpha", "beta", "gamma", "delta"])
+
+    assert index.top_pages("unrelated question", k=2) == [0, 1]
+
+
+@pytest.mark.unit
+def test_top_pages_does_not_pad_partial_matches():
+    """Unmatched pages are not sent to the model when some pages match"""
+    index = PageIndex.from_texts(["alpha", "beta", "gamma", "delta", "gamma delta"])
+
+    assert index.top_pages("gamma", k=3) == [2, 4]
+
+
+@pytest.mark.unit
+def test_top_pages_returns_all_pages_of_short_documents():
+    index = PageIndex.from_texts(["one", "two"])
+
+    assert index.top_pages("anything", k=5) == [0, 1]
@@ -0,0 +1,67 @@
+"""Unit tests for the per-request sampling profiler"""
+import pytest
+import sys
+import threading
+import time
+from pathlib import Path
+
+backend_path = Path(__file__).parent.parent
+sys.path.insert(0, str(backend_path))
+
+from config import Settings, settings
+from profiling import RequestProfile, list_profiles, read_profile
+
+
+def _busy_page_render():
+    deadline = time.monotonic() + 0.2
+    while time.monotonic() < deadline:
+        sum(range(1000))
+
+
+@pytest.mark.unit
+def test_profile_samples_tracked_worker_thread(tmp_path, monkeypatch):
+    """Stacks of tracked worker threads end up in the collapsed output"""
+    monkeypatch.setattr(settings, "profiling_dir", str(tmp_path))
+    profile = RequestProfile("POST", "/multimodal/ask-with-image", interval=0.005)
+
+    profile.start()
+    worker = threading.Thread(target=profile.track(_busy_page_render))
+    worker.start()
+    worker.join()
+    profile.status_code = 200
+    profile.stop()
+    profile.write(tmp_path)
+
+    collapsed = read_profile(profile.profile_id)
+    assert collapsed is not None
+    assert any(
+        line.startswith("worker;") and "_busy_page_render" in line
+        for line in collapsed.splitlines()
+    )
+    metadata = list_profiles()[0]
+    assert metadata["id"] == profile.profile_id
+    assert metadata["status_code"] == 200
+    assert metadata["samples"] > 0
+    assert metadata["wall_ms"] >= 200
+
+
+@pytest.mark.unit
+def test_read_profile_rejects_unexpected_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "profiling_dir", str(tmp_path))
+
+    assert read_profile("../../etc/passwd") is None
+    assert read_profile("20260101T000000000000-deadbeef") is None
+
+
+@pytest.mark.unit
+def test_sample_rate_without_token_is_rejected():
+    """Sampled profiles are only readable via /admin, which needs the token"""
+    with pytest.raises(ValueError, match="PROFILING_TOKEN"):
+        Settings(
+            openai_api_key="key",
+            langfuse_secret_key="secret",
+            langfuse_public_key="public",
+            langfuse_base_url="http://localhost",
+            profiling_token="",
+            profiling_sample_rate=0.5
+        )
@@ -6,7 +6,9 @@ from pathlib import Path
 backend_path = Path(__file__).parent.parent
 sys.path.insert(0, str(backend_path))
 
-from routers.router import classify_and_sanitize
+from routers.router import (
+    classify_and_sanitize, JsonObjectScanner, router_output_budget, ROUTER_MAX_OUTPUT_TOKENS
+)
 
 
 @pytest.mark.integration
@@ -56,3 +58,33 @@ def test_router_pii_redaction():
     
     assert classification.query is not None
     assert classification.agent in ["qa_agent", "irrelevant"]
+
+
+@pytest.mark.unit
+def test_json_scanner_detects_object_end():
+    """Scanner should report completion at the closing brace, ignoring braces in strings"""
+    scanner = JsonObjectScanner()
+    
+    assert not scanner.feed('```json\n{"agent": "qa_agent", ')
+    assert not scanner.feed('"query": "use {braces} and \\"quotes\\""')
+    assert scanner.feed('} trailing text')
+    assert scanner.text == '{"agent": "qa_agent", "query": "use {braces} and \\"quotes\\""}'
+
+
+@pytest.mark.unit
+def test_router_output_budget_scales_with_query():
+    """Output budget should grow with the query and stay capped"""
+    short_budget = router_output_budget("hi")
+    long_budget = router_output_budget("word " * 100)
+    
+    assert short_budget < long_budget
+    assert short_budget < 100
+    assert router_output_budget("word " * 10000) == ROUTER_MAX_OUTPUT_TOKENS
+
+
+@pytest.mark.unit
+def test_router_output_budget_covers_non_latin_queries():
+    """CJK text needs about a token per character, not one per four characters"""
+    query = "我的名字是张伟，我的电话号码是13800138000，请问如何申请育儿假？"
+    
+    assert router_output_budget(query) >= 48 + len(query)
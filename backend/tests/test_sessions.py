@@ -0,0 +1,179 @@
+"""Unit tests for token-budgeted chat sessions"""
+import pytest
+import sys
+import threading
+from pathlib import Path
+
+backend_path = Path(__file__).parent.parent
+sys.path.insert(0, str(backend_path))
+
+import sessions
+from cache import InProcessLRUCache, SharedMemoryCache
+from config import settings
+from sessions import (
+    ChatSession, InMemorySessionStore, CacheSessionStore, SessionSaveError, compact_session
+)
+from tokens import estimate_tokens
+
+BUDGET = 100
+
+
+def _fake_summarize(previous_summary, turns, max_tokens):
+    return (previous_summary + " " + " ".join(str(turn.seq) for turn in turns)).strip()
+
+
+@pytest.mark.unit
+def test_history_stays_within_budget():
+    """Prompt history is bounded by the token budget however long the conversation gets"""
+    store = InMemorySessionStore(max_sessions=10, ttl=3600)
+    session = store.get_or_create()
+    for idx in range(50):
+        session.add_turn("user", f"question {idx} " * 5)
+        session.add_turn("assistant", f"answer {idx} " * 10)
+
+    messages = session.build_messages(BUDGET)
+    assert sum(estimate_tokens(m["content"]) for m in messages) <= BUDGET
+    assert messages[-1]["content"].startswith("answer 49")
+
+
+@pytest.mark.unit
+def test_compaction_summarizes_oldest_turns():
+    store = InMemorySessionStore(max_sessions=10, ttl=3600)
+    session = store.get_or_create()
+    for idx in range(10):
+        session.add_turn("user", "x" * 60)
+    store.save(session)
+    assert session.needs_compaction(BUDGET)
+
+    compact_session(store, session.session_id, BUDGET, _fake_summarize)
+
+    session = store.get(session.session_id)
+    assert session.summary.startswith("0 1")
+    assert session.history_tokens <= BUDGET // 2
+    assert session.history_tokens == sum(turn.tokens for turn in session.turns)
+    assert session.turns[-1].seq == 9
+    assert session.build_messages(BUDGET)[0]["role"] == "system"
+
+
+@pytest.mark.unit
+def test_compaction_keeps_turns_added_meanwhile():
+    """Turns appended while the summary is being generated are not lost"""
+    store = InMemorySessionStore(max_sessions=10, ttl=3600)
+    session = store.get_or_create()
+    for idx in range(10):
+        session.add_turn("user", "x" * 60)
+    store.save(session)
+
+    def summarize_with_concurrent_turn(previous_summary, turns, max_tokens):
+        concurrent = store.get(session.session_id)
+        concurrent.add_turn("user", "follow-up")
+        store.save(concurrent)
+        return _fake_summarize(previous_summary, turns, max_tokens)
+
+    compact_session(store, session.session_id, BUDGET, summarize_with_concurrent_turn)
+
+    session = store.get(session.session_id)
+    assert session.turns[-1].content == "follow-up"
+    assert session.compacting_since is None
+
+
+@pytest.mark.unit
+def test_growing_summary_never_crowds_out_recent_turns():
+    """A summarizer that ignores its limit cannot make prompts grow or hide the last answer"""
+    store = InMemorySessionStore(max_sessions=10, ttl=3600)
+    session = store.get_or_create()
+    store.save(session)
+
+    def verbose_summarize(previous_summary, turns, max_tokens):
+        return previous_summary + " " + "detail " * 200
+
+    def record_exchange(latest):
+        latest.add_turn("user", f"question {idx} " * 5)
+        latest.add_turn("assistant", f"answer {idx} " * 5)
+
+    prompt_sizes = []
+    for idx in range(10):
+        history = store.get(session.session_id).build_messages(BUDGET)
+        prompt_sizes.append(sum(estimate_tokens(m["content"]) for m in history))
+        latest = store.update(session.session_id, record_exchange)
+        if latest.needs_compaction(BUDGET):
+            compact_session(store, session.session_id, BUDGET, verbose_summarize)
+
+    session = store.get(session.session_id)
+    messages = session.build_messages(BUDGET)
+    assert max(prompt_sizes) <= BUDGET + 10  # summary header is not counted
+    assert session.summary_tokens <= BUDGET // 2
+    assert messages[-1]["content"].startswith("answer 9")
+    assert not session.needs_compaction(BUDGET)
+
+
+@pytest.mark.unit
+def test_cache_session_store_raises_when_session_is_not_stored():
+    store = CacheSessionStore(InProcessLRUCache(max_bytes=500), ttl=3600)
+    session = store.get_or_create()
+    session.add_turn("user", "x" * 1000)
+
+    with pytest.raises(SessionSaveError):
+        store.save(session)
+
+
+@pytest.mark.unit
+def test_memory_store_evicts_least_recent_session():
+    store = InMemorySessionStore(max_sessions=2, ttl=3600)
+    for session_id in ["a", "b", "c"]:
+        store.save(ChatSession(session_id=session_id))
+    assert store.get("a") is None
+    assert store.get("c") is not None
+
+
+@pytest.mark.unit
+def test_cache_session_store_roundtrip():
+    store = CacheSessionStore(InProcessLRUCache(max_bytes=100_000), ttl=3600)
+    session = store.get_or_create()
+    session.add_turn("user", "hello")
+    store.save(session)
+    assert store.get(session.session_id).turns[0].content == "hello"
+
+
+@pytest.mark.unit
+def test_unknown_session_id_is_not_adopted():
+    """A client-chosen id that does not exist gets a fresh server-generated id"""
+    store = InMemorySessionStore(max_sessions=10, ttl=3600)
+
+    session = store.get_or_create("attacker-chosen-id")
+
+    assert session.session_id != "attacker-chosen-id"
+    assert len(session.session_id) == 32
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("backend", ["memory", "shm"])
+def test_concurrent_updates_keep_every_turn(backend, tmp_path):
+    if backend == "memory":
+        store = InMemorySessionStore(max_sessions=10, ttl=3600)
+    else:
+        store = CacheSessionStore(SharedMemoryCache(str(tmp_path / "s.sqlite3"), 1_000_000), ttl=3600)
+    session = store.get_or_create()
+    store.save(session)
+
+    def add_turns(worker):
+        for idx in range(10):
+            store.update(session.session_id, lambda s: s.add_turn("user", f"{worker}-{idx}"))
+
+    threads = [threading.Thread(target=add_turns, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(store.get(session.session_id).turns) == 40
+
+
+@pytest.mark.unit
+def test_cache_session_store_requires_a_cache_backend(monkeypatch):
+    monkeypatch.setattr(settings, "session_store", "cache")
+    monkeypatch.setattr(settings, "cache_backend", "none")
+    monkeypatch.setattr(sessions, "_store", None)
+
+    with pytest.raises(ValueError, match="cache_backend=none"):
+        sessions.get_session_store()
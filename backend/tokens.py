@@ -0,0 +1,29 @@
+"""Cheap token-count estimates for budgeting prompts and model outputs
+
+No tokenizer is loaded; estimates err on the high side so that budgets
+derived from them are safe for any language.
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Conservative token estimate
+
+    ASCII text averages about 4 characters per token, while CJK and other
+    non-Latin scripts often need a token or more per character, so every
+    non-ASCII character is counted as a full token.
+    """
+    non_ascii = sum(1 for char in text if not char.isascii())
+    return max(1, (len(text) - non_ascii + 3) // 4 + non_ascii)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of ``text`` whose ``estimate_tokens`` is at most ``max_tokens``"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cost = 0.0
+    for idx, char in enumerate(text):
+        cost += 0.25 if char.isascii() else 1
+        # Keep a token of slack for the rounding up in estimate_tokens
+        if cost > max_tokens - 1:
+            return text[:idx]
+    return text
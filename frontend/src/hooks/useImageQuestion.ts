@@ -9,6 +9,7 @@ export const useImageQuestion = () => {
   const [response, setResponse] = useState<ApiResponse | null>(null)
   const [loading, setLoading] = useState<boolean>(false)
   const [error, setError] = useState<string>('')
+  const [sessionId, setSessionId] = useState<string | null>(null)
 
   const handleImageChange = (file: File | null) => {
     if (file) {
@@ -99,7 +100,7 @@ export const useImageQuestion = () => {
           headers: {
             'Content-Type': 'application/json',
           },
-          body: JSON.stringify({ question: sanitized_query }),
+          body: JSON.stringify({ question: sanitized_query, session_id: sessionId }),
         })
 
         if (!chatRes.ok) {
@@ -107,6 +108,9 @@ export const useImageQuestion = () => {
         }
 
         finalData = await chatRes.json()
+        if (finalData.session_id) {
+          setSessionId(finalData.session_id)
+        }
       }
 
       setResponse(finalData)
@@ -1,6 +1,7 @@
 export interface ApiResponse {
   question: string
   answer: string
+  session_id?: string
   usage?: {
     input: number
     output: number